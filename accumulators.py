@@ -0,0 +1,146 @@
+"""
+@author: Rafal Maselek
+This file contains accumulators of analysis results. They are filled piece by piece (file by file or chunk by chunk)
+and results obtained in different processes can be merged.
+"""
+import numpy as np
+from classification import calculate_binary_coeff
+
+
+class Histogram:
+    """
+    Histogram with fixed bin edges, storing raw counts.
+    """
+    def __init__(self, edges, counts=None):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        if counts is None:
+            counts = np.zeros(len(self.edges)-1)
+        self.counts = np.asarray(counts, dtype=np.float64)
+
+    def fill(self, values, weights=None):
+        """
+        Adds values to the histogram, values outside of the edges are ignored.
+        :param values: Array of values.
+        :param weights: Optional array of weights.
+        :return: nothing
+        """
+        self.counts += np.histogram(np.ravel(values), self.edges,
+                                    weights=None if weights is None else np.ravel(weights))[0]
+
+    def merge(self, other):
+        """
+        Adds counts of another histogram with the same edges.
+        :param other: Histogram object.
+        :return: self
+        """
+        if not np.array_equal(self.edges, other.edges):
+            raise Exception("Histograms with different bin edges can not be merged!")
+        self.counts += other.counts
+        return self
+
+
+class ConfusionCounts:
+    """
+    Numbers of true/false positives/negatives of a binary classification.
+    """
+    def __init__(self, TP=0, FP=0, TN=0, FN=0):
+        self.TP = TP
+        self.FP = FP
+        self.TN = TN
+        self.FN = FN
+
+    def add(self, TP, FP, TN, FN):
+        self.TP += TP
+        self.FP += FP
+        self.TN += TN
+        self.FN += FN
+
+    def merge(self, other):
+        self.add(other.TP, other.FP, other.TN, other.FN)
+        return self
+
+    def coefficients(self, verbose=False):
+        """
+        :return: TPR, SPC, PPV, FPR
+        """
+        return calculate_binary_coeff(self.TP, self.FP, self.TN, self.FN, verbose)
+
+
+class LorFractions:
+    """
+    Numbers of annihilation LORs that are the closest to the origin out of three LORs of an event, the middle one,
+    or the farthest one.
+    """
+    def __init__(self, d_min=0, d_mid=0, d_max=0):
+        self.d_min = d_min
+        self.d_mid = d_mid
+        self.d_max = d_max
+
+    def add(self, d_min, d_mid, d_max):
+        self.d_min += d_min
+        self.d_mid += d_mid
+        self.d_max += d_max
+
+    def merge(self, other):
+        self.add(other.d_min, other.d_mid, other.d_max)
+        return self
+
+    def fractions(self):
+        """
+        :return: Fractions of LORs that are: closest, middle, farthest from the origin (0,0,0 if there are no LORs).
+        """
+        annihilation_lors_no = float(self.d_min+self.d_mid+self.d_max)
+        if annihilation_lors_no == 0:
+            return 0, 0, 0
+        return self.d_min/annihilation_lors_no, self.d_mid/annihilation_lors_no, self.d_max/annihilation_lors_no
+
+
+class HistogramSet:
+    """
+    Histograms with common bin edges, normalized together by the total number of filled values (also those outside
+    of the edges). Raw counts are kept, so sets filled in different processes can be merged before normalization.
+    """
+    def __init__(self, edges, n_histograms):
+        self.histograms = [Histogram(edges) for ii in range(n_histograms)]
+        # numbers of values filled into every histogram
+        self.entries = [0]*n_histograms
+
+    @property
+    def edges(self):
+        return self.histograms[0].edges
+
+    @property
+    def n_entries(self):
+        return sum(self.entries)
+
+    def fill(self, index, values):
+        """
+        Adds values to one of the histograms.
+        :param index: Index of the histogram.
+        :param values: Array of values.
+        :return: nothing
+        """
+        self.histograms[index].fill(values)
+        self.entries[index] += np.size(values)
+
+    def merge(self, other):
+        """
+        Adds counts of another set with the same number of histograms and the same edges.
+        :param other: HistogramSet object.
+        :return: self
+        """
+        if len(self.histograms) != len(other.histograms):
+            raise Exception("Sets with different numbers of histograms can not be merged!")
+        for mine, histogram in zip(self.histograms, other.histograms):
+            mine.merge(histogram)
+        self.entries = [mine+n for mine, n in zip(self.entries, other.entries)]
+        return self
+
+    def normalized(self):
+        """
+        :return: Array of shape (number of histograms, number of bins) with counts divided by the number of entries.
+        """
+        counts = np.array([histogram.counts for histogram in self.histograms])
+        if self.n_entries == 0:
+            return np.zeros_like(counts)
+        return counts/float(self.n_entries)
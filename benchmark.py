@@ -0,0 +1,248 @@
+"""
+@author: Rafal Maselek
+This script measures the time and the peak memory of every stage of the analysis separately: reading the tree, hit
+selection, coincidence typing, pairing with prompt hits, streaming cached selections, finding LORs, classification,
+histogramming and plotting.
+Results are saved to a JSON file, two such files can be compared to find regressions. Unless input files are given,
+synthetic data (synthetic_data.py) is generated, so the benchmark can be run anywhere.
+Usage:
+    python benchmark.py [--events N] [--entries N] [--repeat N] [--output FILE]
+    python benchmark.py --file-511 FILE --file-prompt FILE [--entries N] [--repeat N] [--output FILE]
+    python benchmark.py --compare OLD.json NEW.json [--tolerance 0.1]
+"""
+import argparse
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+import numpy as np
+import data_loader as dl
+import classification as cf
+import instrumentation
+import plotter
+import probability_model
+import synthetic_data
+from accumulators import Histogram
+from event_cache import EventCache
+from parallel_analysis import D_EDGES
+
+DEFAULT_OUTPUT = "benchmark.json"
+# relative increase of time treated as a regression in the compare mode
+DEFAULT_TOLERANCE = 0.1
+
+
+def measure(name, function, n_items, unit, repeat=3):
+    """
+    Measures a single stage. The time is the best of several runs, the peak memory is measured in a separate run,
+    because tracing allocations slows the code down.
+    :param name: Name of the stage.
+    :param function: Function without arguments running the stage.
+    :param n_items: Number of processed items (hits, events, LORs...).
+    :param unit: Name of the items.
+    :param repeat: Number of timed runs.
+    :return: Dictionary with results.
+    """
+    seconds = min(timeit.repeat(function, number=1, repeat=repeat))
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    result = {'stage': name, 'seconds': seconds, 'items': int(n_items), 'unit': unit,
+              'throughput': n_items/seconds if seconds > 0 else float('inf'), 'peak_memory_mb': peak/1024.0**2}
+    print('[{}: {:.4f} s, {:.0f} {}/s, PEAK MEMORY {:.1f} MB]'.format(name.upper(), seconds, result['throughput'],
+                                                                      unit, result['peak_memory_mb']))
+    return result
+
+
+def first_chunk(file_name, n_entries, columns=dl.HIT_BRANCHES, edep_cut=None, use_goja_event_analysis=False):
+    """
+    :return: Dictionary of arrays with at most n_entries first entries of the Hits tree (entries passing the cuts if
+    edep_cut is given).
+    """
+    for chunk in dl.read_hits(file_name, columns, n_entries, edep_cut, use_goja_event_analysis, max_entries=n_entries):
+        return chunk
+    raise Exception("File "+file_name+" has no entries!")
+
+
+def count_streamed_events(file_511, file_prompt, edep_cut, use_goja_event_analysis, cache):
+    """
+    Streams all events of two files through the cache. Files are selected to the end, so that both are cached.
+    :return: Number of events and Instrumentation object with metrics of the run.
+    """
+    metrics = instrumentation.Instrumentation()
+    previous = instrumentation.use(metrics)
+    try:
+        n_events = sum(len(hits_prompt) for hits_511, hits_prompt in
+                       dl.iter_event_tables([file_511], [file_prompt], edep_cut, use_goja_event_analysis, cache=cache,
+                                            complete_files=True))
+    finally:
+        instrumentation.use(previous)
+    return n_events, metrics
+
+
+def run_benchmarks(file_511, file_prompt, n_entries=100000, edep_cut=0.06, use_goja_event_analysis=True,
+                   histograms=[], repeat=3):
+    """
+    Benchmarks all stages on the first n_entries entries of two files.
+    :param file_511: Name of the file with 511 keV data.
+    :param file_prompt: Name of the file with prompt data.
+    :param n_entries: Number of entries read from each file.
+    :param edep_cut: Lower selection value for deposited energy.
+    :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
+    :param histograms: ProbabilityModel object or edep histograms used to calculate LOR probabilities; classification
+    is skipped if empty.
+    :param repeat: Number of timed runs of every stage.
+    :return: List of dictionaries with results.
+    """
+    model = probability_model.as_model(histograms)
+    results = []
+    chunk = first_chunk(file_511, n_entries)
+    n_hits = len(chunk['eventID'])
+    results.append(measure('tree reading', lambda: first_chunk(file_511, n_entries), n_hits, 'hits', repeat))
+    results.append(measure('filtered tree reading',
+                           lambda: first_chunk(file_511, n_entries, dl.LOR_BRANCHES, edep_cut, use_goja_event_analysis),
+                           n_hits, 'hits', repeat))
+
+    hits = dl.HitTable(chunk)
+    results.append(measure('hit selection', lambda: dl.proper_hit_mask(hits, edep_cut, use_goja_event_analysis),
+                           n_hits, 'hits', repeat))
+    # coincidence typing is measured on proper hits only, so that the time of the hit selection is not counted twice
+    proper_hits = hits[dl.proper_hit_mask(hits, edep_cut, use_goja_event_analysis)]
+    results.append(measure('coincidence typing',
+                           lambda: dl.select_coincidences(proper_hits, edep_cut, use_goja_event_analysis,
+                                                          preselected=True),
+                           len(proper_hits), 'hits', repeat))
+
+    pairs = dl.select_coincidences(proper_hits, edep_cut, use_goja_event_analysis, preselected=True)
+    prompts = dl.HitTable(first_chunk(file_prompt, n_entries))
+    prompts = prompts[dl.proper_hit_mask(prompts, edep_cut, use_goja_event_analysis)]
+    chunks = list(dl.pair_event_streams([pairs], [prompts]))
+    hits_511 = dl.HitTable.concatenate([chunk_511 for chunk_511, chunk_prompt in chunks])
+    hits_prompt = dl.HitTable.concatenate([chunk_prompt for chunk_511, chunk_prompt in chunks])
+    n_events = len(hits_prompt)
+    results.append(measure('prompt pairing', lambda: list(dl.pair_event_streams([pairs], [prompts])), n_events,
+                           'events', repeat))
+
+    # whole files are selected once to fill the cache, later runs have to load both streams from it
+    cache_directory = tempfile.mkdtemp(prefix='benchmark_cache_')
+    try:
+        cache = EventCache(cache_directory)
+        count_streamed_events(file_511, file_prompt, edep_cut, use_goja_event_analysis, cache)
+        n_cached, metrics = count_streamed_events(file_511, file_prompt, edep_cut, use_goja_event_analysis, cache)
+        if 'tree reading' in metrics.stages:
+            raise Exception("Cached selections are incomplete, files were read again!")
+        results.append(measure('cached streaming', lambda: count_streamed_events(file_511, file_prompt, edep_cut,
+                                                                                 use_goja_event_analysis, cache),
+                               n_cached, 'events', repeat))
+    finally:
+        shutil.rmtree(cache_directory)
+
+    positions, edeps, coinc_types = dl.table_event_arrays(hits_511, hits_prompt)
+    results.append(measure('finding lors', lambda: dl.lor_batch_from_arrays(positions, edeps, coinc_types, model),
+                           n_events, 'events', repeat))
+
+    lors = dl.lor_batch_from_arrays(positions, edeps, coinc_types, model)
+    d_thresholds = np.linspace(0.0, 450.0, 451)
+    results.append(measure('classification sweep', lambda: cf.binary_classification_simple(lors, d_thresholds),
+                           3*n_events, 'lors', repeat))
+    if model is not None:
+        def classify():
+            lor_pairs = cf.remove_farthest_lor_batch(lors)
+            cf.binary_classification_probability_batch(lor_pairs, use_prompt=False)
+            cf.binary_classification_probability_batch(lor_pairs, use_prompt=True)
+            cf.binary_classification_probability_sophisticated_batch(lor_pairs)
+        results.append(measure('probability classification', classify, 3*n_events, 'lors', repeat))
+
+    results.append(measure('histogramming', lambda: Histogram(D_EDGES).fill(lors.d), 3*n_events, 'lors', repeat))
+
+    TPR, FPR, PPV, SPC = cf.binary_classification_simple(lors, d_thresholds)
+    results.append(measure('plotting', lambda: plotter.plot_classification_plots(TPR, PPV, FPR, d_thresholds,
+                                                                                 'benchmark_classification.png'),
+                           1, 'plots', repeat))
+    return results
+
+
+def save_results(results, parameters, filename=DEFAULT_OUTPUT):
+    """
+    Saves results to a JSON file, together with the parameters of the run and versions of the software.
+    :return: nothing
+    """
+    report = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+              'numpy': np.__version__, 'platform': platform.platform(), 'parameters': parameters, 'stages': results}
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('[RESULTS SAVED TO '+filename+']')
+
+
+def compare_results(old_filename, new_filename, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares times of stages in two result files.
+    :param old_filename: Name of the reference file.
+    :param new_filename: Name of the file with new results.
+    :param tolerance: Relative increase of time treated as a regression.
+    :return: List of names of stages that became slower.
+    """
+    with open(old_filename) as f:
+        old = dict((stage['stage'], stage) for stage in json.load(f)['stages'])
+    with open(new_filename) as f:
+        new = json.load(f)['stages']
+    regressions = []
+    print('{:<28}{:>12}{:>12}{:>10}{:>14}'.format('stage', 'old [s]', 'new [s]', 'ratio', 'memory [MB]'))
+    for stage in new:
+        reference = old.get(stage['stage'])
+        if reference is None:
+            print('{:<28}{:>12}{:>12.4f}'.format(stage['stage'], '-', stage['seconds']))
+            continue
+        ratio = stage['seconds']/reference['seconds'] if reference['seconds'] > 0 else float('inf')
+        flag = ''
+        if ratio > 1.0+tolerance:
+            regressions.append(stage['stage'])
+            flag = '  REGRESSION'
+        print('{:<28}{:>12.4f}{:>12.4f}{:>10.2f}{:>14.1f}{}'.format(stage['stage'], reference['seconds'],
+                                                                 stage['seconds'], ratio, stage['peak_memory_mb'],
+                                                                 flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark of the stages of the analysis.')
+    parser.add_argument('--file-511', help='file with 511 keV data, synthetic data is generated if not given')
+    parser.add_argument('--file-prompt', help='file with prompt data, synthetic data is generated if not given')
+    parser.add_argument('--events', type=int, default=100000, help='number of decays in synthetic files')
+    parser.add_argument('--seed', type=int, default=0, help='seed of synthetic data')
+    parser.add_argument('--entries', type=int, default=100000, help='number of entries read from each file')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs of every stage')
+    parser.add_argument('--edep-cut', type=float, default=0.06)
+    parser.add_argument('--no-goja', action='store_true', help='disable GOJA-like analysis')
+    parser.add_argument('--histograms', default="histogramGOJA.txt",
+                        help='edep histograms (.txt) or probability model (.npz) used by the probability '
+                             'classification, empty to skip it')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare_results(args.compare[0], args.compare[1], args.tolerance) else 0)
+    histograms = probability_model.load_model(args.histograms) if args.histograms else None
+    directory = None
+    if args.file_511 is None or args.file_prompt is None:
+        directory = tempfile.mkdtemp(prefix='benchmark_')
+        (args.file_511,), (args.file_prompt,) = synthetic_data.generate_dataset(directory, 1, args.events,
+                                                                                seed=args.seed)
+    try:
+        results = run_benchmarks(args.file_511, args.file_prompt, args.entries, args.edep_cut, not args.no_goja,
+                                 histograms, args.repeat)
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+    if directory is not None:
+        # names of temporary files are meaningless in the results
+        args.file_511 = args.file_prompt = 'synthetic'
+    save_results(results, vars(args), args.output)
@@ -5,6 +5,8 @@ This file contains functions for statistical classification of events/lors.
 #from data_loader.py import LOR
 import sys
 import numpy as np
+import instrumentation
+from collections import OrderedDict
 
 def calculate_binary_coeff(TP, FP, TN, FN, verbose=False):
     """
@@ -37,6 +39,60 @@ def calculate_binary_coeff(TP, FP, TN, FN, verbose=False):
     return TPR, SPC, PPV, FPR
 
 
+def calculate_binary_coeff_arrays(TP, FP, TN, FN):
+    """
+    Calculates TPR, PPV, FPR and SPC for arrays of counts, with the same conventions as calculate_binary_coeff
+    (a coefficient with zero in the denominator is equal to 1).
+    :param TP: Array of numbers of true positives.
+    :param FP: Array of numbers of false positives.
+    :param TN: Array of numbers of true negatives.
+    :param FN: Array of numbers of false negatives.
+    :return: Arrays TPR, SPC, PPV, FPR
+    """
+    TP, FP, TN, FN = [np.asarray(x, dtype=np.float64) for x in (TP, FP, TN, FN)]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        TPR = np.where(TP+FN == 0, 1.0, TP/(TP+FN))
+        SPC = np.where(TN+FP == 0, 1.0, TN/(TN+FP))
+        PPV = np.where(TP+FP == 0, 1.0, TP/(TP+FP))
+        FPR = np.where(TN+FP == 0, 1.0, 1.0-TN/(TN+FP))
+    return TPR, SPC, PPV, FPR
+
+
+def lor_arrays(lors):
+    """
+    Extracts distances and truth flags from LORs.
+    :param lors: List of LOR objects or an object holding arrays of them (e.g. data_loader.LorBatch).
+    :return: Arrays d and is_from_annihilation (flattened).
+    """
+    if isinstance(getattr(lors, 'd', None), np.ndarray):
+        return np.ravel(lors.d), np.ravel(lors.is_from_annihilation)
+    d = np.array([lor.d for lor in lors], dtype=np.float64)
+    is_from_annihilation = np.array([lor.is_from_annihilation for lor in lors], dtype=bool)
+    return d, is_from_annihilation
+
+
+def threshold_counts(d, is_positive, d_thresholds):
+    """
+    Counts TP, FP, TN, FN for many thresholds in one pass: values are sorted once and counts below every threshold are
+    read from cumulative sums. A LOR is classified as positive if d <= threshold.
+    :param d: Array of LOR distances.
+    :param is_positive: Boolean array, true for LORs that are really positive.
+    :param d_thresholds: Array of threshold values of LOR distance.
+    :return: Arrays TP, FP, TN, FN, one element per threshold.
+    """
+    d = np.asarray(d, dtype=np.float64)
+    is_positive = np.asarray(is_positive, dtype=bool)
+    with instrumentation.stage('classification sweep', len(d)):
+        order = np.argsort(d, kind='mergesort')
+        cumulative_positive = np.concatenate(([0], np.cumsum(is_positive[order])))
+        n_below = np.searchsorted(d[order], np.asarray(d_thresholds, dtype=np.float64), side='right')
+        TP = cumulative_positive[n_below]
+        FP = n_below - TP
+        FN = cumulative_positive[-1] - TP
+        TN = (len(d) - cumulative_positive[-1]) - FP
+    return TP, FP, TN, FN
+
+
 def binary_classification_simple(lors, d_thresholds):
     """
     Calculates TPR, PPV, FPR and SPC for many values of d_threshold
@@ -44,30 +100,25 @@ def binary_classification_simple(lors, d_thresholds):
     :param d_thresholds: Array of threshold values of LOR distance.
     :return: Arrays TPR, FPR, PPV, SPC for all values of thresholds.
     """
-    TPR = []
-    FPR = []
-    PPV = []
-    SPC = []
-    for d_t in d_thresholds:
-        FP=FN=TP=TN=0
-        for lor in lors:
-            if lor.d > d_t:
-                if lor.is_from_annihilation:
-                    FN += 1
-                else:
-                    TN += 1
-            else:
-                if lor.is_from_annihilation:
-                    TP += 1
-                else:
-                    FP += 1
-        tpr, spc, ppv, fpr = calculate_binary_coeff(TP, FP, TN, FN)
-        TPR.append(tpr)
-        FPR.append(fpr)
-        PPV.append(ppv)
-        SPC.append(spc)
+    d, is_from_annihilation = lor_arrays(lors)
+    TP, FP, TN, FN = threshold_counts(d, is_from_annihilation, d_thresholds)
+    TPR, SPC, PPV, FPR = calculate_binary_coeff_arrays(TP, FP, TN, FN)
+    print("[BINARY CLASSIFICATION DONE]")
+    return TPR.tolist(), FPR.tolist(), PPV.tolist(), SPC.tolist()
+
+
+def roc_curve(lors):
+    """
+    Calculates the exact ROC curve, using every distinct value of LOR distance as a threshold.
+    :param lors: Array of LORs.
+    :return: Arrays d_thresholds, TPR, FPR, PPV, SPC.
+    """
+    d, is_from_annihilation = lor_arrays(lors)
+    d_thresholds = np.unique(d)
+    TP, FP, TN, FN = threshold_counts(d, is_from_annihilation, d_thresholds)
+    TPR, SPC, PPV, FPR = calculate_binary_coeff_arrays(TP, FP, TN, FN)
     print("[BINARY CLASSIFICATION DONE]")
-    return TPR, FPR, PPV, SPC
+    return d_thresholds, TPR, FPR, PPV, SPC
 
 
 def remove_farthest_lor(lors):
@@ -132,7 +183,7 @@ def binary_classification_probability_sophisticated(pairs_of_lors, verbose=False
         for ii in range(2):
             lor = pair[ii]
             p.append(lor.annihilation_p * (1.0-lor.p_prompt_and_511))
-            if pair[ii].d < pair[(ii+1)%2]:
+            if pair[ii].d < pair[(ii+1)%2].d:
                 p[ii] *= 0.9
             else:
                 p[ii] *= 0.1
@@ -157,3 +208,179 @@ def binary_classification_probability_sophisticated(pairs_of_lors, verbose=False
     tpr, spc, ppv, fpr = calculate_binary_coeff(TP, FP, TN, FN, verbose)
     print("[BINARY CLASSIFICATION DONE]")
     return tpr, spc, ppv, fpr
+
+
+# columns of the two LORs left in an event after removing LOR number 0, 1 or 2
+_PAIR_COLUMNS = np.array([[1, 2], [0, 2], [0, 1]])
+
+
+class LorPairs:
+    """
+    Pairs of LORs left after removing the farthest LOR from every event, stored as arrays of shape (M, 2).
+    """
+    def __init__(self, d, is_from_annihilation, is_prompt, annihilation_p, p_prompt_and_511):
+        self.d = d
+        self.is_from_annihilation = is_from_annihilation
+        self.is_prompt = is_prompt
+        self.annihilation_p = annihilation_p
+        self.p_prompt_and_511 = p_prompt_and_511
+
+    def __len__(self):
+        return len(self.d)
+
+
+def remove_farthest_lor_batch(lors):
+    """
+    Vectorized remove_farthest_lor. Events in which the farthest LOR is not unique are skipped, as in
+    remove_farthest_lor.
+    :param lors: Object with LOR arrays of shape (N, 3), e.g. data_loader.LorBatch.
+    :return: LorPairs object.
+    """
+    d = np.asarray(lors.d)
+    is_kept = d < d.max(axis=1)[:, np.newaxis]
+    rows = np.flatnonzero(np.count_nonzero(is_kept, axis=1) == 2)
+    columns = _PAIR_COLUMNS[np.argmax(d[rows], axis=1)]
+    rows = rows[:, np.newaxis]
+    print("[FARTHEST LORS REMOVED]")
+    return LorPairs(d[rows, columns], np.asarray(lors.is_from_annihilation)[rows, columns],
+                    np.asarray(lors.is_prompt)[rows, columns], np.asarray(lors.annihilation_p)[rows, columns],
+                    np.asarray(lors.p_prompt_and_511)[rows, columns])
+
+
+def decide_max_probability(p):
+    """
+    LOR with the greatest probability in a pair is classified as positive (both of them in case of a tie).
+    :param p: Array of probabilities of shape (M, 2).
+    :return: Boolean array of shape (M, 2), true for LORs classified as positive.
+    """
+    return p == p.max(axis=1)[:, np.newaxis]
+
+
+def decide_sophisticated(pairs):
+    """
+    Decision rule of binary_classification_probability_sophisticated: the probability that LOR is true is weighted by
+    0.9 for the closer LOR of a pair and by 0.1 for the farther one.
+    :param pairs: LorPairs object.
+    :return: Boolean array of shape (M, 2), true for LORs classified as positive.
+    """
+    p = pairs.annihilation_p * (1.0-pairs.p_prompt_and_511)
+    p = p * np.where(pairs.d < pairs.d[:, ::-1], 0.9, 0.1)
+    is_first = p[:, 0] > p[:, 1]
+    return np.column_stack((is_first, ~is_first))
+
+
+def confusion_counts(predicted, truth):
+    """
+    Counts the outcomes of a binary classification.
+    :param predicted: Boolean array, true for objects classified as positive.
+    :param truth: Boolean array, true for objects that are really positive.
+    :return: TP, FP, TN, FN
+    """
+    predicted = np.asarray(predicted, dtype=bool)
+    truth = np.asarray(truth, dtype=bool)
+    with instrumentation.stage('classification', predicted.size):
+        TP = int(np.count_nonzero(predicted & truth))
+        FP = int(np.count_nonzero(predicted & ~truth))
+        TN = int(np.count_nonzero(~predicted & ~truth))
+        FN = int(np.count_nonzero(~predicted & truth))
+    return TP, FP, TN, FN
+
+
+def decide_max_annihilation_p(pairs):
+    """
+    Decision rule of binary_classification_probability with use_prompt=False (hypothesis 1).
+    :param pairs: LorPairs object.
+    :return: Boolean array of shape (M, 2), true for LORs classified as true.
+    """
+    return decide_max_probability(pairs.annihilation_p)
+
+
+def decide_max_prompt_p(pairs):
+    """
+    Decision rule of binary_classification_probability with use_prompt=True (hypothesis 2).
+    :param pairs: LorPairs object.
+    :return: Boolean array of shape (M, 2), true for LORs classified as containing the prompt hit.
+    """
+    return decide_max_probability(pairs.p_prompt_and_511)
+
+
+# decision rules evaluated by evaluate_classifiers: name -> (function deciding on LorPairs, name of the LorPairs array
+# with real classes)
+DECISION_RULES = OrderedDict()
+
+
+def register_rule(name, decide, truth='is_from_annihilation'):
+    """
+    Adds a decision rule evaluated by default by evaluate_classifiers.
+    :param name: Name of the rule.
+    :param decide: Function taking a LorPairs object and returning a boolean array of shape (M, 2), true for LORs
+    classified as positive. It has to be defined at the top level of a module to be used by worker processes.
+    :param truth: Name of the LorPairs array that is true for really positive LORs: 'is_from_annihilation' or
+    'is_prompt'.
+    :return: nothing
+    """
+    DECISION_RULES[name] = (decide, truth)
+
+
+def use_rules(rules):
+    """
+    Replaces all registered decision rules. Used as the initializer of worker processes, which get only the built-in
+    rules when they are not forked from the parent (spawn and forkserver start methods). Functions are sent to workers
+    by reference, so they have to be defined at the top level of a module.
+    :param rules: Dictionary name -> (decide, truth) like DECISION_RULES.
+    :return: nothing
+    """
+    # with the fork start method rules can be DECISION_RULES itself, so they are copied before it is cleared
+    rules = list(rules.items())
+    DECISION_RULES.clear()
+    DECISION_RULES.update(rules)
+
+
+register_rule('511', decide_max_annihilation_p)
+register_rule('prompt', decide_max_prompt_p, 'is_prompt')
+register_rule('sophisticated', decide_sophisticated)
+
+
+def evaluate_classifiers(pairs, rules=None):
+    """
+    Evaluates many decision rules on the same pairs of LORs.
+    :param pairs: LorPairs object.
+    :param rules: Names of registered rules, a dictionary name -> (decide, truth) like DECISION_RULES with rules that
+    are not registered, or None for all registered rules.
+    :return: OrderedDict mapping names of rules to tuples (TP, FP, TN, FN).
+    """
+    if rules is None:
+        rules = DECISION_RULES
+    elif not isinstance(rules, dict):
+        rules = OrderedDict((name, DECISION_RULES[name]) for name in rules)
+    counts = OrderedDict()
+    for name, (decide, truth) in rules.items():
+        counts[name] = confusion_counts(decide(pairs), getattr(pairs, truth))
+    return counts
+
+
+def binary_classification_probability_batch(pairs, use_prompt=False, verbose=False):
+    """
+    Vectorized binary_classification_probability.
+    :param pairs: LorPairs object.
+    :param use_prompt: If False, LOR with the greatest probability to be true is true, otherwise LOR with the greatest
+    probability to contain one prompt and one 511 keV hit contains the prompt hit.
+    :return: TPR, SPC, PPV, FPR
+    """
+    name = 'prompt' if use_prompt else '511'
+    TP, FP, TN, FN = evaluate_classifiers(pairs, [name])[name]
+    tpr, spc, ppv, fpr = calculate_binary_coeff(TP, FP, TN, FN, verbose)
+    print("[BINARY CLASSIFICATION DONE]")
+    return tpr, spc, ppv, fpr
+
+
+def binary_classification_probability_sophisticated_batch(pairs, verbose=False):
+    """
+    Vectorized binary_classification_probability_sophisticated.
+    :param pairs: LorPairs object.
+    :return: TPR, SPC, PPV, FPR
+    """
+    TP, FP, TN, FN = evaluate_classifiers(pairs, ['sophisticated'])['sophisticated']
+    tpr, spc, ppv, fpr = calculate_binary_coeff(TP, FP, TN, FN, verbose)
+    print("[BINARY CLASSIFICATION DONE]")
+    return tpr, spc, ppv, fpr
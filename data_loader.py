@@ -1,15 +1,67 @@
 """
 @author: Rafal Maselek
 This file contains functions that load and sort data.
-It contains definitions of Lor and Hit classes.
+It contains definitions of Lor, Hit and HitTable classes.
 """
-from ROOT import gROOT, TCanvas, TH1, TH2, TTree, TFile
-import math
-import sys
+from ROOT import gROOT, TCanvas, TH1, TH2, TTree, TChain, RDataFrame, gInterpreter
+import json
+import instrumentation
+import probability_model
 import numpy as np
 from enum import Enum
 from matplotlib import pyplot as plt
 
+# branches of the GATE Hits tree used by Hit class
+HIT_BRANCHES = ['PDGEncoding', 'trackID', 'parentID', 'time', 'edep', 'posX', 'posY', 'posZ', 'baseID', 'photonID',
+                'nPhantomCompton', 'nCrystalCompton', 'nPhantomRayleigh', 'nCrystalRayleigh', 'primaryID',
+                'sourcePosX', 'sourcePosY', 'sourcePosZ', 'sourceID', 'eventID', 'volumeID',
+                'processName', 'comptVolName', 'RayleighVolName']
+# branches holding C-strings
+STRING_BRANCHES = ['processName', 'comptVolName', 'RayleighVolName']
+# branches needed by select_coincidences for hits that already passed is_proper_hit
+COINCIDENCE_BRANCHES = ['nPhantomCompton', 'nCrystalCompton', 'eventID']
+# branches needed to find LORs
+LOR_BRANCHES = ['edep', 'posX', 'posY', 'posZ']
+# length of the volumeID array in GATE output
+VOLUME_ID_SIZE = 10
+# number of tree entries read in one bulk call
+DEFAULT_CHUNK_SIZE = 1000000
+# number of events in a chunk of the streaming pipeline
+DEFAULT_CHUNK_EVENTS = 100000
+# version of cached selections, part of the key of event_cache entries; changes of the selection functions are detected
+# from their source code (event_cache.SELECTION_CODE), this number has to be increased only when selected hits change
+# for another reason, e.g. a new format of saved tables
+SELECTION_VERSION = 2
+# columns of GOJA-like output and their formats
+GOJA_COLUMNS = ('x1', 'y1', 'z1', 't1', 'x2', 'y2', 'z2', 't2', 'vol1', 'vol2', 'e1', 'e2', 'coincType',
+                'sourcePosX', 'sourcePosY', 'sourcePosZ')
+GOJA_FORMAT = '%.2f\t%.2f\t%.2f\t%.1f\t%.2f\t%.2f\t%.2f\t%.1f\t%.1f\t%.1f\t%.2f\t%.2f\t%d\t%.2f\t%.2f\t%.2f'
+# number of rows formatted at once when writing text output
+GOJA_CHUNK_ROWS = 100000
+# C++ version of is_compton_process used by filters of RDataFrame, strings are compared the same way as the strings
+# returned by AsNumpy
+COMPTON_PROCESS_CODE = '''
+#include <cctype>
+#include <string>
+bool is_compton_process(std::string process_name)
+{
+    if (!process_name.empty()) process_name.erase(process_name.size()-1);
+    for (std::string::size_type ii = 0; ii < process_name.size(); ++ii)
+        process_name[ii] = std::tolower(static_cast<unsigned char>(process_name[ii]));
+    const char* whitespace = " \\t\\n\\r\\f\\v";
+    std::string::size_type first = process_name.find_first_not_of(whitespace);
+    if (first == std::string::npos) return false;
+    process_name = process_name.substr(first, process_name.find_last_not_of(whitespace)-first+1);
+    return process_name == "compton" || process_name == "compt";
+}
+'''
+# number of chunks of a file filled by one event loop of RDataFrame; more chunks mean fewer passes over the tree, but
+# more memory, because all of them are converted into arrays at once
+CHUNKS_PER_LOOP = 10
+
+# True once COMPTON_PROCESS_CODE was declared to the ROOT interpreter
+_compton_process_declared = False
+
 
 class CoincType(Enum):
     """
@@ -60,6 +112,225 @@ class Hit:
                             self.processName, self.comptVolName, self.RayleighVolName]
 
 
+class StringCategories:
+    """
+    Lookup table between strings and small integer codes. String branches (process and volume names) are stored as
+    codes, so cuts on them become integer comparisons and every hit needs one or two bytes instead of a string.
+    """
+    def __init__(self, names=()):
+        self.names = []
+        self._codes = {}
+        for name in names:
+            self.code(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def code(self, name):
+        """
+        Returns the code of a string, the string is added to the table if it is not there yet.
+        :param name: String.
+        :return: Integer code.
+        """
+        code = self._codes.get(name)
+        if code is None:
+            code = len(self.names)
+            self._codes[name] = code
+            self.names.append(name)
+        return code
+
+    def dtype(self):
+        """
+        :return: The smallest unsigned integer type able to hold all codes.
+        """
+        return np.uint8 if len(self.names) <= 256 else np.uint16
+
+    def encode(self, values):
+        """
+        Converts strings into codes. Every distinct string is looked up only once.
+        :param values: Array of strings.
+        :return: Array of codes.
+        """
+        values = np.asarray(values, dtype=object)
+        if len(values) == 0:
+            return np.zeros(0, dtype=self.dtype())
+        uniques, inverse = np.unique(values, return_inverse=True)
+        lookup = np.array([self.code(name) for name in uniques.tolist()], dtype=np.int64)
+        return lookup[inverse.reshape(-1)].astype(self.dtype())
+
+    def decode(self, codes):
+        """
+        Converts codes back into strings.
+        :param codes: Array of codes.
+        :return: Array of strings.
+        """
+        return np.array(self.names, dtype=object)[codes]
+
+    def flags(self, predicate):
+        """
+        Evaluates a predicate once for every string in the table.
+        :param predicate: Function taking a string and returning a bool.
+        :return: Boolean array indexed by codes.
+        """
+        return np.array([bool(predicate(name)) for name in self.names], dtype=bool)
+
+
+class HitTable:
+    """
+    Struct-of-arrays container of hits. Every field of Hit is stored in a single typed NumPy column, so a table of
+    millions of hits takes a fraction of the memory of Hit objects and can be processed with vectorized operations.
+    String fields are stored as codes of StringCategories tables (table.processName gives codes, a HitView gives the
+    string). Integer indexing returns a HitView, indexing with a slice, an index array or a mask returns a new HitTable
+    (slices share memory with the original table).
+    """
+    def __init__(self, columns, categories=None):
+        self.columns = dict(columns)
+        if categories is None:
+            categories = dict((column, StringCategories()) for column in STRING_BRANCHES)
+        self.categories = categories
+        for column in STRING_BRANCHES:
+            values = self.columns.get(column)
+            if values is not None and values.dtype == object:
+                self.columns[column] = categories[column].encode(values)
+        if 'coincType' not in self.columns:
+            self.columns['coincType'] = np.full(len(self.columns['eventID']), CoincType.kUnspecified.value,
+                                                dtype=np.int8)
+
+    @classmethod
+    def empty(cls, categories=None):
+        """
+        Creates a table without any hits.
+        :param categories: Dictionary of StringCategories objects for string columns.
+        :return: HitTable object.
+        """
+        columns = {}
+        for column in HIT_BRANCHES:
+            if column == 'volumeID':
+                columns[column] = np.zeros((0, VOLUME_ID_SIZE), dtype=np.int32)
+            elif column in STRING_BRANCHES:
+                columns[column] = np.zeros(0, dtype=np.uint8)
+            else:
+                columns[column] = np.zeros(0)
+        return cls(columns, categories)
+
+    @classmethod
+    def concatenate(cls, tables):
+        """
+        Joins tables into a single one. String codes are translated if tables use different categories.
+        :param tables: List of HitTable objects with the same columns.
+        :return: HitTable object.
+        """
+        tables = [table for table in tables if len(table) > 0]
+        if len(tables) == 0:
+            return cls.empty()
+        if len(tables) == 1:
+            return tables[0]
+        categories = tables[0].categories
+        columns = {}
+        for column in tables[0].columns:
+            if column in categories:
+                parts = []
+                for table in tables:
+                    codes = table.columns[column]
+                    if table.categories[column] is not categories[column]:
+                        codes = categories[column].encode(table.categories[column].decode(codes))
+                    parts.append(codes)
+                # the lookup table might have grown while translating codes
+                columns[column] = np.concatenate(parts).astype(categories[column].dtype())
+            else:
+                columns[column] = np.concatenate([table.columns[column] for table in tables])
+        return cls(columns, categories)
+
+    def save(self, file_name):
+        """
+        Saves the table to a binary .npz file, one array per column.
+        :param file_name: Name of the output file.
+        :return: nothing
+        """
+        arrays = dict(('column_'+column, values) for column, values in self.columns.items())
+        # json keeps every character of the strings, also trailing null characters
+        arrays['categories'] = np.array(json.dumps(dict((column, categories.names)
+                                                        for column, categories in self.categories.items())))
+        with open(file_name, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, file_name):
+        """
+        Loads a table saved with HitTable.save.
+        :param file_name: Name of the input file.
+        :return: HitTable object.
+        """
+        with np.load(file_name) as arrays:
+            categories = dict((column, StringCategories(names))
+                              for column, names in json.loads(str(arrays['categories'])).items())
+            columns = dict((name[len('column_'):], arrays[name]) for name in arrays.files if name.startswith('column_'))
+        return cls(columns, categories)
+
+    def __len__(self):
+        return len(self.columns['eventID'])
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError('hit index out of range')
+            return HitView(self, key)
+        return HitTable(dict((column, values[key]) for column, values in self.columns.items()), self.categories)
+
+    def __iter__(self):
+        for ii in range(len(self)):
+            yield HitView(self, ii)
+
+    def __getattr__(self, name):
+        # gives access to whole columns, e.g. table.edep
+        columns = self.__dict__.get('columns')
+        if columns is None or name not in columns:
+            raise AttributeError(name)
+        return columns[name]
+
+
+class HitView:
+    """
+    Single row of HitTable with the attribute interface of Hit. It does not copy any data.
+    """
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getattr__(self, name):
+        try:
+            value = self.table.columns[name][self.index]
+        except KeyError:
+            raise AttributeError(name)
+        if name in self.table.categories:
+            return self.table.categories[name].names[value]
+        # python scalars keep the arithmetic identical to the values returned by the tree
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+
+    @property
+    def coincType(self):
+        return CoincType(int(self.table.columns['coincType'][self.index]))
+
+    @coincType.setter
+    def coincType(self, value):
+        self.table.columns['coincType'][self.index] = value.value
+
+    @property
+    def allFields(self):
+        return [getattr(self, field) for field in ('PDGEncoding', 'trackID', 'parentID', 'time', 'edep', 'posX',
+                                                   'posY', 'posZ', 'nPhantomCompton', 'baseID', 'photonID',
+                                                   'nCrystalCompton', 'nPhantomRayleigh', 'nCrystalRayleigh',
+                                                   'primaryID', 'sourcePosX', 'sourcePosY', 'sourcePosZ', 'sourceID',
+                                                   'eventID', 'volumeID', 'processName', 'comptVolName',
+                                                   'RayleighVolName')]
+
+
 class LOR:
     """Class represnting a single Line of response in 2D."""
     def __init__(self, d, is_from_annihilation, is_prompt, annihilation_p, p_prompt_and_511):
@@ -70,6 +341,55 @@ class LOR:
         self.p_prompt_and_511 = p_prompt_and_511
 
 
+class LorBatch:
+    """
+    LORs of many events stored as arrays of shape (N, 3). LOR number ii of an event connects its hits ii and (ii+1)%3,
+    so LOR 0 connects the two annihilation hits and LORs 1 and 2 contain the prompt hit.
+    """
+    def __init__(self, d, is_from_annihilation, is_prompt, annihilation_p, p_prompt_and_511):
+        self.d = d
+        self.is_from_annihilation = is_from_annihilation
+        self.is_prompt = is_prompt
+        self.annihilation_p = annihilation_p
+        self.p_prompt_and_511 = p_prompt_and_511
+
+    def __len__(self):
+        return len(self.d)
+
+    def to_lors(self):
+        """
+        Builds LOR objects in the same order as find_lors.
+        :return: Lists of LOR objects: all LORs, LORs coming from annihilation, LORs containing prompt hit, LORs coming
+        from annihilation that weren't scattered.
+        """
+        lors = []
+        lors_annihilation = []
+        lors_with_prompt = []
+        lors_true_annihilation = []
+        for d, is_from_annihilation, is_prompt, annihilation_p, p_prompt_and_511 in \
+                zip(self.d.tolist(), self.is_from_annihilation.tolist(), self.is_prompt.tolist(),
+                    self.annihilation_p.tolist(), self.p_prompt_and_511.tolist()):
+            for ii in range(3):
+                lor = LOR(d[ii], is_from_annihilation[ii], is_prompt[ii], annihilation_p[ii], p_prompt_and_511[ii])
+                lors.append(lor)
+                if is_prompt[ii]:
+                    lors_with_prompt.append(lor)
+                else:
+                    lors_annihilation.append(lor)
+                    if is_from_annihilation[ii]:
+                        lors_true_annihilation.append(lor)
+        return lors, lors_annihilation, lors_with_prompt, lors_true_annihilation
+
+
+def is_compton_process(process_name):
+    """
+    Checks if the name of a process comes from Compton scattering.
+    :param process_name: Value of processName branch.
+    :return: True for Compton scattering.
+    """
+    return process_name[:-1].lower().strip() in ('compton', 'compt')
+
+
 def is_proper_hit(hit, edep_cut, use_goja_event_analysis=False):
     """
     Checks if hit passes some basic selections.
@@ -80,7 +400,7 @@ def is_proper_hit(hit, edep_cut, use_goja_event_analysis=False):
     """
     val = hit.nCrystalRayleigh==0 and hit.nPhantomRayleigh==0 \
         and hit.edep >= edep_cut and hit.PDGEncoding == 22 \
-        and (hit.processName[:-1].lower().strip() == 'compton' or hit.processName[:-1].lower().strip() ==  'compt')
+        and is_compton_process(hit.processName)
     # if use_goja_event_analysis==False then check additional constraint
     if not use_goja_event_analysis:
         return val and hit.nCrystalCompton==1 #and hit.nPhantomCompton==0
@@ -134,151 +454,649 @@ def find_coincidences(hits, edep_cut, use_goja_event_analysis=False):
     return []
 
 
-def load_data(file_list_511, file_list_prompt, edep_cut = 0.06, use_goja_event_analysis=False):
+def proper_hit_mask(hits, edep_cut, use_goja_event_analysis=False):
     """
-    Loads data from files with 511 keV and prompt data.
+    Vectorized version of is_proper_hit.
+    :param hits: HitTable object.
+    :param edep_cut: Value of lower cut on deposited energy.
+    :param use_goja_event_analysis: If false, hits have to be scattered only once in the detector.
+    :return: Boolean array, true for hits that pass all selections.
+    """
+    # the process name is checked once per category, not once per hit
+    is_compton = hits.categories['processName'].flags(is_compton_process)[hits.processName]
+    no_rayleigh = (hits.nCrystalRayleigh == 0) & (hits.nPhantomRayleigh == 0)
+    # compared in double precision, like in is_proper_hit and in filters of the reader
+    passes_edep = hits.edep.astype(np.float64) >= edep_cut
+    is_gamma = hits.PDGEncoding == 22
+    mask = no_rayleigh & passes_edep & is_gamma & is_compton
+    cuts = [('rayleigh', no_rayleigh), ('edep', passes_edep), ('pdg', is_gamma), ('process', is_compton)]
+    if not use_goja_event_analysis:
+        single_compton = hits.nCrystalCompton == 1
+        mask &= single_compton
+        cuts.append(('nCrystalCompton', single_compton))
+    instrumentation.cut_flow('hit selection', cuts)
+    return mask
+
+
+def hit_cuts(edep_cut, use_goja_event_analysis=False):
+    """
+    Cuts of is_proper_hit as expressions of RDataFrame filters, in the same order as the cuts of proper_hit_mask.
+    :param edep_cut: Value of lower cut on deposited energy.
+    :param use_goja_event_analysis: If false, hits have to be scattered only once in the detector.
+    :return: List of tuples (name of the cut, C++ expression).
+    """
+    global _compton_process_declared
+    if not _compton_process_declared:
+        if not gInterpreter.Declare(COMPTON_PROCESS_CODE):
+            raise Exception("Cannot declare is_compton_process to the ROOT interpreter!")
+        _compton_process_declared = True
+    cuts = [('rayleigh', 'nCrystalRayleigh == 0 && nPhantomRayleigh == 0'),
+            ('edep', 'edep >= {!r}'.format(float(edep_cut))),
+            ('pdg', 'PDGEncoding == 22'),
+            ('process', 'is_compton_process(processName)')]
+    if not use_goja_event_analysis:
+        cuts.append(('nCrystalCompton', 'nCrystalCompton == 1'))
+    return cuts
+
+
+def event_starts(event_ids):
+    """
+    Finds the boundaries of groups of consecutive hits with the same eventID.
+    :param event_ids: Array of eventIDs.
+    :return: Array of indices of the first hit of every group.
+    """
+    if len(event_ids) == 0:
+        return np.zeros(0, dtype=int)
+    return np.flatnonzero(np.concatenate(([True], event_ids[1:] != event_ids[:-1])))
+
+
+def select_coincidences(hits, edep_cut, use_goja_event_analysis=False, preselected=False):
+    """
+    Batch equivalent of grouping hits by eventID and calling find_coincidences for every group. All groups are
+    processed at once with array operations.
+    :param hits: HitTable object, hits with the same eventID have to be stored next to each other.
+    :param edep_cut: Lower selection cut on deposited energy.
+    :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
+    :param preselected: If true, all hits are known to pass is_proper_hit (cuts were applied by read_hits) and only
+    COINCIDENCE_BRANCHES are needed.
+    :return: HitTable of coincidences: rows 2*i and 2*i+1 form the i-th coincidence; coincidence types are set.
+    """
+    if preselected:
+        # hits were already selected and counted by read_hits
+        proper = np.ones(len(hits), dtype=bool)
+    else:
+        with instrumentation.stage('hit selection', len(hits)):
+            proper = proper_hit_mask(hits, edep_cut, use_goja_event_analysis)
+    if len(hits) == 0:
+        return hits[proper]
+    with instrumentation.stage('coincidence typing', len(hits)):
+        starts = event_starts(hits.eventID)
+        n_proper = np.add.reduceat(proper.astype(np.int64), starts)
+        if not use_goja_event_analysis and np.any(n_proper > 2):
+            print('[EVENTS WITH MORE THAN 2 PROPER GAMMAS, NOT IN GOJA MODE: {}]'
+                  .format(np.count_nonzero(n_proper > 2)))
+        group_sizes = np.diff(np.append(starts, len(hits)))
+        pairs = hits[proper & np.repeat(n_proper == 2, group_sizes)]
+
+        # the same rules as in goja_event_analysis
+        event_ids = pairs.eventID.reshape(-1, 2)
+        no_phantom_compton = np.all(pairs.nPhantomCompton.reshape(-1, 2) == 0, axis=1)
+        single_crystal_compton = np.all(pairs.nCrystalCompton.reshape(-1, 2) == 1, axis=1)
+        coinc_type = np.where(no_phantom_compton,
+                              np.where(single_crystal_compton, CoincType.kTrue.value,
+                                       CoincType.kDetectorScattered.value),
+                              CoincType.kPhantomScattered.value)
+        coinc_type = np.where(event_ids[:, 0] == event_ids[:, 1], coinc_type, CoincType.kAccidental.value)
+        pairs.columns['coincType'] = np.repeat(coinc_type, 2).astype(np.int8)
+    instrumentation.count('coincidences', len(coinc_type))
+    return pairs
+
+
+def last_event_start(tree, n_entries):
+    """
+    Finds the first entry of the last event of a tree. Entries are read one by one from the end, only the eventID
+    branch is read and no event loop is run.
+    :param tree: TTree or TChain with the Hits tree.
+    :param n_entries: Number of entries of the tree.
+    :return: Index of the first entry of the last group of consecutive entries with the same eventID.
+    """
+    tree.SetBranchStatus('*', 0)
+    tree.SetBranchStatus('eventID', 1)
+    try:
+        last_event_id = None
+        for entry in range(n_entries-1, -1, -1):
+            tree.GetEntry(entry)
+            if last_event_id is None:
+                last_event_id = tree.eventID
+            elif tree.eventID != last_event_id:
+                return entry+1
+        return 0
+    finally:
+        tree.SetBranchStatus('*', 1)
+
+
+def read_hits(file_name, columns=HIT_BRANCHES, chunk_size=DEFAULT_CHUNK_SIZE, edep_cut=None,
+              use_goja_event_analysis=False, drop_last_event=False, max_entries=None):
+    """
+    Reads the Hits tree from a GATE output file. Instead of walking the tree entry by entry, whole branches of a range
+    of entries are pulled into NumPy arrays with a single bulk call. Only the requested branches are read. If edep_cut
+    is given, the cuts of is_proper_hit are evaluated by filters of RDataFrame, so rejected entries are never converted
+    into arrays. Actions of CHUNKS_PER_LOOP consecutive chunks are booked together, so they are filled by a single
+    event loop. Files with names ending with .npz are read as tables saved with HitTable.save.
+    :param file_name: Name of the ROOT or .npz file.
+    :param columns: Names of the branches to read.
+    :param chunk_size: Maximal number of tree entries in a chunk (before cuts).
+    :param edep_cut: Lower selection cut on deposited energy, None to read all entries without cuts.
+    :param use_goja_event_analysis: If false, hits have to be scattered only once in the detector (used with edep_cut).
+    :param drop_last_event: If true, entries of the last event of the file are not read.
+    :param max_entries: Maximal number of entries read from the beginning of the file, None to read all entries.
+    :return: Generator of dictionaries mapping branch names to arrays, one dictionary per chunk of entries.
+    """
+    if file_name.endswith('.npz'):
+        # array files written by HitTable.save, e.g. synthetic data
+        with instrumentation.stage('tree reading') as stage:
+            hits = HitTable.load(file_name)
+            stage.n_items = len(hits)
+        if drop_last_event and len(hits) > 0:
+            hits = hits[:event_starts(hits.eventID)[-1]]
+        if max_entries is not None:
+            hits = hits[:max_entries]
+        if edep_cut is not None:
+            with instrumentation.stage('hit selection', len(hits)):
+                hits = hits[proper_hit_mask(hits, edep_cut, use_goja_event_analysis)]
+        for start in range(0, len(hits), chunk_size):
+            chunk = {}
+            for column in columns:
+                values = hits.columns[column][start:start+chunk_size]
+                if column in hits.categories:
+                    values = hits.categories[column].decode(values)
+                chunk[column] = values
+            yield chunk
+        return
+    chain = TChain('Hits')
+    chain.Add(file_name)
+    # the number of entries is kept in the header of the tree, so no event loop is needed to get it
+    n_entries = chain.GetEntries()
+    if drop_last_event:
+        n_entries = last_event_start(chain, n_entries)
+    if max_entries is not None:
+        n_entries = min(n_entries, max_entries)
+    frame = RDataFrame(chain)
+    cuts = [] if edep_cut is None else hit_cuts(edep_cut, use_goja_event_analysis)
+    names = []
+    for column in columns:
+        if column == 'volumeID':
+            # fixed-size array branches are split into scalar columns, so that they are read as plain numbers
+            for ii in range(VOLUME_ID_SIZE):
+                frame = frame.Define('volumeID_{}'.format(ii), 'volumeID[{}]'.format(ii))
+                names.append('volumeID_{}'.format(ii))
+        else:
+            names.append(column)
+    chunk_starts = list(range(0, n_entries, chunk_size))
+    for first in range(0, len(chunk_starts), CHUNKS_PER_LOOP):
+        # nothing is read until the first result is used, then one event loop fills the arrays of all booked chunks
+        booked = []
+        for start in chunk_starts[first:first+CHUNKS_PER_LOOP]:
+            stop = min(start+chunk_size, n_entries)
+            selected = frame.Range(start, stop)
+            for cut_name, expression in cuts:
+                selected = selected.Filter(expression, cut_name)
+            # the cut flow report is filled by the same event loop as the arrays
+            report = selected.Report() if len(cuts) > 0 and instrumentation.enabled() else None
+            booked.append((stop-start, selected.AsNumpy(names, lazy=True), report))
+        for n_read, result, report in booked:
+            with instrumentation.stage('tree reading', n_read):
+                arrays = result.GetValue()
+            if report is not None:
+                instrumentation.cut_counts('hit selection', n_read,
+                                           [(cut.GetName(), cut.GetAll()-cut.GetPass()) for cut in report])
+            yield branch_arrays(arrays, columns)
+
+
+def branch_arrays(arrays, columns):
+    """
+    Converts arrays returned by AsNumpy into the format of read_hits.
+    :param arrays: Dictionary of arrays returned by AsNumpy, volumeID is split into scalar columns volumeID_<index>.
+    :param columns: Names of the branches.
+    :return: Dictionary mapping branch names to arrays.
+    """
+    chunk = {}
+    for column in columns:
+        if column == 'volumeID':
+            chunk[column] = np.column_stack([arrays['volumeID_{}'.format(ii)] for ii in range(VOLUME_ID_SIZE)])
+        elif column in STRING_BRANCHES:
+            # object arrays keep the strings intact (fixed-width unicode arrays would drop trailing null characters)
+            chunk[column] = np.array([str(value) for value in arrays[column]], dtype=object)
+        else:
+            chunk[column] = np.asarray(arrays[column])
+    return chunk
+
+
+def selected_branches(columns, required):
+    """
+    :param columns: Names of branches requested by the caller.
+    :param required: Names of branches needed by the selection.
+    :return: Union of both lists in the order of HIT_BRANCHES.
+    """
+    return [column for column in HIT_BRANCHES if column in columns or column in required]
+
+
+def iter_file_coincidences(file_name, edep_cut, use_goja_event_analysis=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                           categories=None, columns=HIT_BRANCHES):
+    """
+    Selects coincidences from a file with 511 keV data, chunk by chunk. Hits are selected by read_hits, so only proper
+    hits are read.
+    :param file_name: Name of the file.
+    :param edep_cut: Lower selection value for deposited energy.
+    :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
+    :param chunk_size: Number of tree entries read from the file in one bulk call.
+    :param categories: Dictionary of StringCategories objects for string columns.
+    :param columns: Names of the branches needed by the caller, branches needed by the selection are always read.
+    :return: Generator of HitTables of pairs of hits forming coincidences, one table per chunk of entries.
+    """
+    # hits of the last, possibly incomplete, event of a chunk are carried over to the next chunk
+    carry = None
+    # as in the original entry-by-entry loop, the last event of a file is never analysed
+    for chunk in read_hits(file_name, selected_branches(columns, COINCIDENCE_BRANCHES), chunk_size, edep_cut,
+                           use_goja_event_analysis, drop_last_event=True):
+        hits = HitTable(chunk, categories)
+        if carry is not None:
+            hits = HitTable.concatenate([carry, hits])
+        starts = event_starts(hits.eventID)
+        if len(starts) == 0:
+            continue
+        carry = hits[starts[-1]:]
+        yield select_coincidences(hits[:starts[-1]], edep_cut, use_goja_event_analysis, preselected=True)
+    if carry is not None:
+        yield select_coincidences(carry, edep_cut, use_goja_event_analysis, preselected=True)
+
+
+def select_file_coincidences(file_name, edep_cut, use_goja_event_analysis=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                             categories=None, columns=HIT_BRANCHES):
+    """
+    Selects coincidences from a file with 511 keV data.
+    :param file_name: Name of the file.
+    :param edep_cut: Lower selection value for deposited energy.
+    :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
+    :param chunk_size: Number of tree entries read from the file in one bulk call.
+    :param categories: Dictionary of StringCategories objects for string columns.
+    :param columns: Names of the branches needed by the caller.
+    :return: HitTable of pairs of hits forming coincidences.
+    """
+    return HitTable.concatenate(list(iter_file_coincidences(file_name, edep_cut, use_goja_event_analysis, chunk_size,
+                                                            categories, columns)))
+
+
+def iter_file_prompts(file_name, edep_cut, use_goja_event_analysis=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                      categories=None, columns=HIT_BRANCHES):
+    """
+    Selects proper hits from a file with prompt data, chunk by chunk. Hits are selected by read_hits, so only proper
+    hits are read.
+    :param file_name: Name of the file.
+    :param edep_cut: Lower selection value for deposited energy.
+    :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
+    :param chunk_size: Number of tree entries read from the file in one bulk call.
+    :param categories: Dictionary of StringCategories objects for string columns.
+    :param columns: Names of the branches needed by the caller, eventID is always read.
+    :return: Generator of HitTables of prompt hits, one table per chunk of entries.
+    """
+    for chunk in read_hits(file_name, selected_branches(columns, ['eventID']), chunk_size, edep_cut,
+                           use_goja_event_analysis):
+        yield HitTable(chunk, categories)
+
+
+def select_file_prompts(file_name, edep_cut, use_goja_event_analysis=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                        categories=None, limit=None, columns=HIT_BRANCHES):
+    """
+    Selects proper hits from a file with prompt data.
+    :param file_name: Name of the file.
+    :param edep_cut: Lower selection value for deposited energy.
+    :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
+    :param chunk_size: Number of tree entries read from the file in one bulk call.
+    :param categories: Dictionary of StringCategories objects for string columns.
+    :param limit: Maximal number of selected hits, reading stops when it is reached. None means no limit.
+    :param columns: Names of the branches needed by the caller.
+    :return: HitTable of prompt hits.
+    """
+    tables = []
+    n_selected = 0
+    for hits in iter_file_prompts(file_name, edep_cut, use_goja_event_analysis, chunk_size, categories, columns):
+        if limit is not None:
+            hits = hits[:limit-n_selected]
+        tables.append(hits)
+        n_selected += len(hits)
+        if limit is not None and n_selected >= limit:
+            break
+    return HitTable.concatenate(tables)
+
+
+def select_file_hits(file_name, edep_cut, use_goja_event_analysis=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                     categories=None, columns=HIT_BRANCHES, drop_last_event=False):
+    """
+    Selects proper hits from a file without grouping them into coincidences, e.g. to apply tighter edep cuts later
+    with select_coincidences(..., preselected=True).
+    :param file_name: Name of the file.
+    :param edep_cut: Lower selection value for deposited energy.
+    :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
+    :param chunk_size: Number of tree entries read from the file in one bulk call.
+    :param categories: Dictionary of StringCategories objects for string columns.
+    :param columns: Names of the branches to read, eventID is always read.
+    :param drop_last_event: If true, hits of the last event of the file are skipped, like by iter_file_coincidences.
+    :return: HitTable of proper hits.
+    """
+    return HitTable.concatenate([HitTable(chunk, categories)
+                                 for chunk in read_hits(file_name, selected_branches(columns, ['eventID']), chunk_size,
+                                                        edep_cut, use_goja_event_analysis, drop_last_event)])
+
+
+def iter_selections(file_list, kind, edep_cut, use_goja_event_analysis=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                    categories=None, cache=None, columns=HIT_BRANCHES, complete_files=False):
+    """
+    Selects hits from consecutive files, chunk by chunk. Selections found in the cache are not recalculated, a file is
+    added to the cache once all of its chunks were selected. A file whose generator is closed in the middle of it is
+    not cached, unless complete_files is true.
+    :param file_list: List of file names.
+    :param kind: '511' for coincidences from 511 keV data, 'prompt' for prompt hits.
+    :param edep_cut: Lower selection value for deposited energy.
+    :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
+    :param chunk_size: Number of tree entries read from a file in one bulk call.
+    :param categories: Dictionary of StringCategories objects for string columns.
+    :param cache: Optional event_cache.EventCache object.
+    :param columns: Names of the branches needed by the caller.
+    :param complete_files: If true and the generator is closed in the middle of a file, the rest of the file is
+    selected anyway to fill the cache entry (used with a cache only).
+    :return: Generator of HitTables.
+    """
+    select = iter_file_coincidences if kind == '511' else iter_file_prompts
+    for file_name in file_list:
+        print("[LOADING: "+file_name+"]")
+        if cache is None:
+            for hits in select(file_name, edep_cut, use_goja_event_analysis, chunk_size, categories, columns):
+                yield hits
+            continue
+        hits = cache.load(file_name, kind, edep_cut, use_goja_event_analysis, columns)
+        if hits is not None:
+            yield hits
+            continue
+        tables = []
+        selection = select(file_name, edep_cut, use_goja_event_analysis, chunk_size, categories, columns)
+        try:
+            for hits in selection:
+                tables.append(hits)
+                yield hits
+        except GeneratorExit:
+            # the stream was closed, e.g. by pair_event_streams when the other stream ended; a partial selection would
+            # be a wrong cache entry, so the file is cached only if the caller asked to select it to the end
+            if complete_files:
+                tables.extend(selection)
+                cache.save(file_name, kind, edep_cut, use_goja_event_analysis, HitTable.concatenate(tables), columns)
+            raise
+        cache.save(file_name, kind, edep_cut, use_goja_event_analysis, HitTable.concatenate(tables), columns)
+
+
+def pair_event_streams(source_511, source_prompt, chunk_events=DEFAULT_CHUNK_EVENTS):
+    """
+    Pairs coincidences of 511 keV hits with prompt hits, in order, while reading both sources together. A chunk of
+    events is emitted as soon as both sides have data, so neither side is read ahead of the other by more than one
+    table. When one source is exhausted, the other one is closed without being read further.
+    :param source_511: Iterator of HitTables of pairs of annihilation hits.
+    :param source_prompt: Iterator of HitTables of prompt hits.
+    :param chunk_events: Maximal number of events in a chunk.
+    :return: Generator of tuples of two HitTables: pairs of annihilation hits and prompt hits of the same events.
+    """
+    source_511 = iter(source_511)
+    source_prompt = iter(source_prompt)
+    pending_511 = HitTable.empty()
+    pending_prompt = HitTable.empty()
+    try:
+        while True:
+            if len(pending_511) < 2:
+                hits = next(source_511, None)
+                if hits is None:
+                    break
+                pending_511 = HitTable.concatenate([pending_511, hits])
+                continue
+            if len(pending_prompt) == 0:
+                hits = next(source_prompt, None)
+                if hits is None:
+                    break
+                pending_prompt = hits
+                continue
+            n_events = min(len(pending_511)//2, len(pending_prompt), chunk_events)
+            instrumentation.count('paired events', n_events)
+            yield pending_511[:2*n_events], pending_prompt[:n_events]
+            pending_511 = pending_511[2*n_events:]
+            pending_prompt = pending_prompt[n_events:]
+    finally:
+        for source in (source_511, source_prompt):
+            if hasattr(source, 'close'):
+                source.close()
+
+
+def iter_event_tables(file_list_511, file_list_prompt, edep_cut=0.06, use_goja_event_analysis=False,
+                      chunk_events=DEFAULT_CHUNK_EVENTS, chunk_size=DEFAULT_CHUNK_SIZE, cache=None,
+                      columns=HIT_BRANCHES, complete_files=False):
+    """
+    Streaming version of load_event_tables. Events are yielded in chunks, so the memory used does not depend on the
+    number of files. Concatenated chunks are equal to the tables returned by load_event_tables.
     :param file_list_511: List of files of 511 keV data.
     :param file_list_prompt: List of files of prompt data.
     :param edep_cut: Lower selection value for deposited energy.
     :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
-    :return: Four lists of events: true, phantom-scattered, detector-scattered, accidental.
+    :param chunk_events: Maximal number of events in a chunk.
+    :param chunk_size: Number of tree entries read from a file in one bulk call.
+    :param cache: Optional event_cache.EventCache object.
+    :param columns: Names of the branches needed by the caller, e.g. LOR_BRANCHES. Other branches are not read.
+    :param complete_files: If true, a file left unfinished when the other stream ends is still selected to the end,
+    so that it is cached (see iter_selections).
+    :return: Generator of tuples of two HitTables: pairs of annihilation hits and prompt hits of the same events.
     """
+    # one lookup table for string branches is shared by all files
+    categories = dict((column, StringCategories()) for column in STRING_BRANCHES)
+    source_511 = iter_selections(file_list_511, '511', edep_cut, use_goja_event_analysis, chunk_size, categories,
+                                 cache, columns, complete_files)
+    source_prompt = iter_selections(file_list_prompt, 'prompt', edep_cut, use_goja_event_analysis, chunk_size,
+                                    categories, cache, columns, complete_files)
+    return pair_event_streams(source_511, source_prompt, chunk_events)
 
-    print('\n[LOADING 511 KEV DATA...]')
-    proper_hits_511 = []
-    proper_hits_prompt = []
-    add_to_proper_hits_511 = proper_hits_511.append
-    add_to_proper_hits_prompt = proper_hits_prompt.append
-
-    # loading of 511 keV data
-    for f511_file_name in file_list_511:
-        print("[LOADING: "+f511_file_name+"]")
-        f_511 = TFile(f511_file_name)
-        bufor = []
-        # TODO: Optimize reading from the tree, because it takes way to much time
-        for event in f_511.Hits:
-            if len(bufor) == 0 or bufor[0].eventID == event.eventID:
-                bufor.append(Hit(event))
-            else:
-                for proper_hit in find_coincidences(bufor, edep_cut, use_goja_event_analysis):
-                    add_to_proper_hits_511(proper_hit)
-                bufor = [Hit(event)]
-        f_511.Close()
-
-
-    print('[511 KEV DATA LOADED. LOADING PROMPT DATA...]')
-    # loading prompt data
-    for f_prompt_file_name in file_list_prompt:
-        print("[LOADING: "+f_prompt_file_name+"]")
-        f_prompt = TFile(f_prompt_file_name)
-        for event in f_prompt.Hits :
-            if is_proper_hit(event, edep_cut, use_goja_event_analysis):
-                add_to_proper_hits_prompt(Hit(event))
-            if 2*len(proper_hits_prompt) > len(proper_hits_511):
-                break
-        f_prompt.Close()
 
+def load_coincidences(file_list_511, edep_cut=0.06, use_goja_event_analysis=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                      cache=None):
+    """
+    Loads coincidences of 511 keV hits only, without pairing them with prompt hits.
+    :param file_list_511: List of files of 511 keV data.
+    :param edep_cut: Lower selection value for deposited energy.
+    :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
+    :param chunk_size: Number of tree entries read from a file in one bulk call.
+    :param cache: Optional event_cache.EventCache object.
+    :return: HitTable of pairs of annihilation hits (rows 2*i and 2*i+1 belong to the i-th coincidence).
+    """
+    return HitTable.concatenate(list(iter_selections(file_list_511, '511', edep_cut, use_goja_event_analysis,
+                                                     chunk_size, cache=cache)))
 
-    # truncating the data to equal number of events      
-    n_511 = len(proper_hits_511)
-    n_prompt = len(proper_hits_prompt)
-    if n_511//2 > n_prompt:
-        n_events = n_prompt
-    else:
-        n_events = n_511//2
-
-    print('[NO OF EVENTS: {}]'.format(n_events))
-
-    events_true = []
-    events_phantom_scattered = []
-    events_detector_scattered = []
-    events_accidental = []
-    add_to_true = events_true.append
-    add_to_phantom_scattered = events_phantom_scattered.append
-    add_to_detector_scattered = events_detector_scattered.append
-    add_to_accidental = events_accidental.append
-    # classifying events based on the coincidence type of the two annihilation gammas
-    for ii in range(n_events):
-        ev = (proper_hits_511[2*ii], proper_hits_511[2*ii+1], proper_hits_prompt[ii])
-        t = proper_hits_511[2*ii].coincType
-        if t == CoincType.kTrue:
-            add_to_true(ev)
-        elif t == CoincType.kPhantomScattered:
-            add_to_phantom_scattered(ev)
-        elif t == CoincType.kDetectorScattered:
-            add_to_detector_scattered(ev)
-        elif t == CoincType.kAccidental:
-            add_to_accidental(ev)
+
+def load_event_tables(file_list_511, file_list_prompt, edep_cut=0.06, use_goja_event_analysis=False,
+                      chunk_size=DEFAULT_CHUNK_SIZE, cache=None, columns=HIT_BRANCHES):
+    """
+    Loads data from files with 511 keV and prompt data in batch mode, without creating any per-hit objects. Files of
+    both kinds are read together and reading stops as soon as one kind of data is exhausted.
+    :param file_list_511: List of files of 511 keV data.
+    :param file_list_prompt: List of files of prompt data.
+    :param edep_cut: Lower selection value for deposited energy.
+    :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
+    :param chunk_size: Number of tree entries read from a file in one bulk call.
+    :param cache: Optional event_cache.EventCache object. Selections found there are not recalculated, new ones are
+    stored in it.
+    :param columns: Names of the branches needed by the caller. Other branches are not read.
+    :return: Two HitTables: pairs of annihilation hits (rows 2*i and 2*i+1 belong to the i-th event) and prompt hits
+    (row i belongs to the i-th event), both truncated to the same number of events.
+    """
+    print('\n[LOADING DATA...]')
+    tables_511 = []
+    tables_prompt = []
+    for hits_511, hits_prompt in iter_event_tables(file_list_511, file_list_prompt, edep_cut,
+                                                   use_goja_event_analysis, chunk_size=chunk_size, cache=cache,
+                                                   columns=columns):
+        tables_511.append(hits_511)
+        tables_prompt.append(hits_prompt)
+    proper_hits_511 = HitTable.concatenate(tables_511)
+    proper_hits_prompt = HitTable.concatenate(tables_prompt)
+    print('[NO OF EVENTS: {}]'.format(len(proper_hits_prompt)))
+    return proper_hits_511, proper_hits_prompt
+
+
+def group_events(hits_511, hits_prompt):
+    """
+    Splits events into groups by the coincidence type of the two annihilation gammas.
+    :param hits_511: HitTable of pairs of annihilation hits, as returned by load_event_tables.
+    :param hits_prompt: HitTable of prompt hits, as returned by load_event_tables.
+    :return: Four lists of events (tuples of two annihilation hits and a prompt hit): true, phantom-scattered,
+    detector-scattered, accidental.
+    """
+    coinc_types = hits_511.coincType[0::2]
+    groups = []
+    for t in (CoincType.kTrue, CoincType.kPhantomScattered, CoincType.kDetectorScattered, CoincType.kAccidental):
+        groups.append([(hits_511[2*ii], hits_511[2*ii+1], hits_prompt[ii])
+                       for ii in np.flatnonzero(coinc_types == t.value).tolist()])
+    return groups
+
+
+def load_data(file_list_511, file_list_prompt, edep_cut = 0.06, use_goja_event_analysis=False,
+              chunk_size=DEFAULT_CHUNK_SIZE, cache=None):
+    """
+    Loads data from files with 511 keV and prompt data.
+    :param file_list_511: List of files of 511 keV data.
+    :param file_list_prompt: List of files of prompt data.
+    :param edep_cut: Lower selection value for deposited energy.
+    :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
+    :param chunk_size: Number of tree entries read from a file in one bulk call.
+    :param cache: Optional event_cache.EventCache object with selected hits.
+    :return: Four lists of events: true, phantom-scattered, detector-scattered, accidental.
+    """
+    hits_511, hits_prompt = load_event_tables(file_list_511, file_list_prompt, edep_cut, use_goja_event_analysis,
+                                              chunk_size, cache)
+    events_true, events_phantom_scattered, events_detector_scattered, events_accidental = \
+        group_events(hits_511, hits_prompt)
     print('[NO OF TRUE EVENTS: {}, NO OF PHANTOM-SCATTERED EVENTS: {}, NO OF DETECTOR-SCATTERED EVENTS: {}, NO OF ACCIDENTAL EVENTS: {}]'\
         .format(len(events_true), len(events_phantom_scattered), len(events_detector_scattered), len(events_accidental)))
     print('[DATA LOADED]')
     return events_true, events_phantom_scattered, events_detector_scattered, events_accidental
 
 
+def event_arrays(events):
+    """
+    Collects the data needed to find LORs from a list of events.
+    :param events: List of events (tuples of two annihilation hits and a prompt hit).
+    :return: Arrays of hit positions (N, 3, 3), deposited energies (N, 3) and coincidence types (N,).
+    """
+    positions = np.array([[(hit.posX, hit.posY, hit.posZ) for hit in event[:3]] for event in events],
+                         dtype=np.float64).reshape(-1, 3, 3)
+    edeps = np.array([[hit.edep for hit in event[:3]] for event in events], dtype=np.float64).reshape(-1, 3)
+    coinc_types = np.array([event[0].coincType.value for event in events], dtype=np.int8)
+    return positions, edeps, coinc_types
+
+
+def table_event_arrays(hits_511, hits_prompt):
+    """
+    Same as event_arrays, but for events stored in HitTables returned by load_event_tables.
+    :param hits_511: HitTable of pairs of annihilation hits.
+    :param hits_prompt: HitTable of prompt hits.
+    :return: Arrays of hit positions (N, 3, 3), deposited energies (N, 3) and coincidence types (N,).
+    """
+    n_events = len(hits_prompt)
+    positions = np.empty((n_events, 3, 3))
+    edeps = np.empty((n_events, 3))
+    for ii, name in enumerate(('posX', 'posY', 'posZ')):
+        positions[:, :2, ii] = getattr(hits_511, name).reshape(-1, 2)
+        positions[:, 2, ii] = getattr(hits_prompt, name)
+    edeps[:, :2] = hits_511.edep.reshape(-1, 2)
+    edeps[:, 2] = hits_prompt.edep
+    return positions, edeps, hits_511.coincType[0::2]
+
+
+def lor_distances(positions):
+    """
+    Calculates distances between the origin and LORs of many events at once. 3D LORs are analysed.
+    :param positions: Array of hit positions of shape (N, 3, 3): event, hit, coordinate.
+    :return: Array of shape (N, 3), element [n, ii] is the distance for LOR connecting hits ii and (ii+1)%3 of event n.
+    """
+    p1 = positions
+    p2 = np.roll(positions, -1, axis=1)
+    # vectors representing the directions of LORs
+    l = p1-p2
+    # s indicates intersection point on LOR with the normal that passes through the origin
+    s = -(p1[..., 0]*l[..., 0]+p1[..., 1]*l[..., 1]+p1[..., 2]*l[..., 2])/(l[..., 0]**2+l[..., 1]**2+l[..., 2]**2)
+    p_intersection = p1 + s[..., np.newaxis]*l
+    return np.sqrt(p_intersection[..., 0]**2+p_intersection[..., 1]**2+p_intersection[..., 2]**2)
+
+
+def lor_probabilities(histograms, edep1, edep2):
+    """
+    Calculates probabilities for LORs connecting hits with given deposited energies. LORs with a hit outside of the
+    histogram range get zero probabilities.
+    :param histograms: ProbabilityModel object or edep histograms (e.g. loaded from histogram.txt).
+    :param edep1: Array of deposited energies of the first hit.
+    :param edep2: Array of deposited energies of the second hit.
+    :return: Arrays of probabilities that both photons are 511 keV and that one is 511 keV and the other is prompt.
+    """
+    return probability_model.as_model(histograms).probabilities(edep1, edep2)
+
+
+def lor_batch_from_arrays(positions, edeps, coinc_types, histograms=[]):
+    """
+    Finds LORs for arrays of events.
+    :param positions: Array of hit positions of shape (N, 3, 3).
+    :param edeps: Array of deposited energies of shape (N, 3).
+    :param coinc_types: Array of coincidence types (values of CoincType) of shape (N,).
+    :param histograms: ProbabilityModel object or edep histograms (e.g. loaded from histogram.txt) used to calculate
+    probabilities.
+    :return: LorBatch object.
+    """
+    model = probability_model.as_model(histograms)
+    with instrumentation.stage('finding lors', len(positions)):
+        d = lor_distances(positions)
+        n_events = len(d)
+        is_from_annihilation = np.zeros((n_events, 3), dtype=bool)
+        is_from_annihilation[:, 0] = coinc_types == CoincType.kTrue.value
+        is_prompt = np.ones((n_events, 3), dtype=bool)
+        is_prompt[:, 0] = False
+        if model is not None:
+            annihilation_p, p_prompt_and_511 = model.probabilities(edeps, np.roll(edeps, -1, axis=1))
+        else:
+            annihilation_p = np.ones((n_events, 3))
+            p_prompt_and_511 = np.ones((n_events, 3))
+        return LorBatch(d, is_from_annihilation, is_prompt, annihilation_p, p_prompt_and_511)
+
+
+def find_lor_batch(events, histograms=[]):
+    """
+    Batch version of find_lors, LOR objects are not created.
+    :param events: List of events.
+    :param histograms: ProbabilityModel object or edep histograms (e.g. loaded from histogram.txt) used to calculate
+    probabilities.
+    :return: LorBatch object.
+    """
+    positions, edeps, coinc_types = event_arrays(events)
+    return lor_batch_from_arrays(positions, edeps, coinc_types, histograms)
+
+
 def find_lors(events, histograms = [], verbose=False):
     """
     Finds LOR parameters: distance from the origin and angle between OX axis and vector from the origin to the center of LOR.
     Projections of 3D LORs onto OXY plane are analysed.
     :param events: List of events.
+    :param histograms: ProbabilityModel object or edep histograms used to calculate probabilities.
     :return: Lists of LOR objects: all LORs, LORs coming from annihilation that weren't scattered, LORs containg prompt hit.
     """
-    lors = []
-    lors_true_annihilation = []
-    lors_annihilation = []
-    lors_with_prompt = []
-    probs511 = []
-    probsPrompt = []
-    for event in events:
-        for ii in range(3):
-            edep1 = event[ii].edep
-            edep2 = event[(ii+1)%3].edep
-            p1 = np.array([event[ii].posX, event[ii].posY, event[ii].posZ])
-            p2 = np.array([event[(ii+1)%3].posX, event[(ii+1)%3].posY, event[(ii+1)%3].posZ])
-            # construct vector representing the direction of LOR
-            l = p1-p2
-            # find s, which idicates intersection point on LOR with the normal that passes through the origin
-            s = -(p1[0]*l[0]+p1[1]*l[1]+p1[2]*l[2])/(l[0]**2+l[1]**2+l[2]**2)
-            p_intersection = p1 + s*l
-            # d is the distance between the origin (point (0,0,0)) and LOR (intersection point)
-            d = np.sqrt(p_intersection[0]**2+p_intersection[1]**2+p_intersection[2]**2)
-
-            p511 = 1.0
-            p_prompt_and_511 = 1.0
-            if len(histograms) > 0:
-                # find the probability that LOR is true
-                # find the bin for given edep1 and edep2
-                index1 = 0
-                while histograms[0][index1] < edep1:
-                    index1 += 1
-                index2 = 0
-                while histograms[0][index2] < edep2:
-                    index2 += 1
-                # probability that both photons are 511 keV 
-                p511 *= histograms[1][index1-1] * histograms[1][index2-1]
-                # probability thar one is 511 and the other is prompt
-                #(p1(prompt)*p2(511) + p1(511)*p2(prompt))
-                p_prompt_and_511 = (histograms[4][index1-1] * histograms[1][index2-1] + histograms[1][index1-1] * histograms[4][index2-1])
-
-            # for LORs with both annihilation hits (we take ii=0 and ii+1 into consideration)
-            if ii == 0:
-                is_true_annihilation = (event[ii].coincType == CoincType.kTrue)
-                lors.append(LOR(d, is_true_annihilation, False, p511, p_prompt_and_511)) # True for back-to-back emission
-                lors_annihilation.append(LOR(d, is_true_annihilation, False, p511, p_prompt_and_511))
-                if is_true_annihilation:
-                    lors_true_annihilation.append(LOR(d, is_true_annihilation, False, p511, p_prompt_and_511))
-            # for LORs with prompt hit
-            else:
-                lors.append(LOR(d, False, True, p511, p_prompt_and_511))
-                lors_with_prompt.append(LOR(d, False, True, p511, p_prompt_and_511))
-            probs511.append(p511)
-            probsPrompt.append(p_prompt_and_511)
+    batch = find_lor_batch(events, histograms)
     if verbose:
         print('[Verbose mode is ON. Histogram of LORs probabilities will be saved to a file.]')
-        plt.hist([probs511, probsPrompt], 100, histtype='step', fill=False, stacked=False, normed=False, label=["511", "prompt"])
+        plt.hist([batch.annihilation_p.ravel(), batch.p_prompt_and_511.ravel()], 100, histtype='step', fill=False,
+                 stacked=False, label=["511", "prompt"])
         plt.legend(loc='upper right')
         plt.savefig("p_plots.png")
     print('[LORS FOUND]')
-    return lors, lors_annihilation, lors_with_prompt, lors_true_annihilation
+    return batch.to_lors()
 
 
 def count_sorted_lors(lors):
@@ -315,22 +1133,90 @@ def count_sorted_lors(lors):
     return d_min/annihilation_lors_no, d_mid/annihilation_lors_no, d_max/annihilation_lors_no
 
 
-def write_goja_output(coincidences, filename='goja_output.txt'):
+def count_sorted_lor_batch(lors):
     """
-    Writes GOJA-like output to a text file.
-    :param coincidences: List of coincidences (pairs of Hits).
+    Vectorized count_sorted_lors.
+    :param lors: LorBatch object.
+    :return: Numbers of annihilation LORs that are: closest, middle, farthest from the origin.
+    """
+    rows = np.flatnonzero(np.any(lors.is_from_annihilation, axis=1))
+    index = np.argmax(lors.is_from_annihilation[rows], axis=1)
+    d = lors.d[rows, index]
+    d_next = lors.d[rows, (index+1)%3]
+    d_last = lors.d[rows, (index+2)%3]
+    is_min = (d < d_next) & (d < d_last)
+    is_mid = ~is_min & ((d < d_next) | (d < d_last))
+    d_min = int(np.count_nonzero(is_min))
+    d_mid = int(np.count_nonzero(is_mid))
+    return d_min, d_mid, len(rows)-d_min-d_mid
+
+
+def goja_rows(coincidences):
+    """
+    Calculates rows of GOJA-like output: positions [cm], times [ps], volumeIDs, deposited energies [keV], coincidence
+    type and source position [cm].
+    :param coincidences: List of coincidences (pairs of Hits) or HitTable of pairs of hits (rows 2*i and 2*i+1 belong
+    to the i-th coincidence).
+    :return: Array of shape (N, 16).
+    """
+    if isinstance(coincidences, HitTable):
+        # float branches are converted first, so that the arithmetic is done in double precision like for Hits
+        names = ('posX', 'posY', 'posZ', 'time', 'volumeID', 'edep', 'coincType', 'sourcePosX', 'sourcePosY',
+                 'sourcePosZ')
+        h1 = dict((name, coincidences.columns[name][0::2].astype(np.float64)) for name in names)
+        h2 = dict((name, coincidences.columns[name][1::2].astype(np.float64)) for name in names)
+        columns = [h1['posX']/10.0, h1['posY']/10.0, h1['posZ']/10.0, h1['time']*10**12,
+                   h2['posX']/10.0, h2['posY']/10.0, h2['posZ']/10.0, h2['time']*10**12,
+                   h1['volumeID'][:, 1], h2['volumeID'][:, 1], h1['edep']*1000, h2['edep']*1000,
+                   h1['coincType'], h1['sourcePosX']/10.0, h1['sourcePosY']/10.0, h1['sourcePosZ']/10.0]
+        return np.column_stack(columns).reshape(-1, 16)
+    for coinc in coincidences:
+        if len(coinc) < 2:
+            raise Exception("A coincidence provided with less than two hits!")
+    return np.array([[h1.posX/10.0, h1.posY/10.0, h1.posZ/10.0, h1.time*10**12,
+                      h2.posX/10.0, h2.posY/10.0, h2.posZ/10.0, h2.time*10**12,
+                      h1.volumeID[1], h2.volumeID[1], h1.edep*1000, h2.edep*1000,
+                      h1.coincType.value, h1.sourcePosX/10.0, h1.sourcePosY/10.0, h1.sourcePosZ/10.0]
+                     for h1, h2 in (coinc[:2] for coinc in coincidences)], dtype=np.float64).reshape(-1, 16)
+
+
+def write_goja_output(coincidences, filename='goja_output.txt', binary=False, append=False):
+    """
+    Writes GOJA-like output to a text file. Rows are formatted in chunks, with a single formatting operation per
+    chunk.
+    :param coincidences: List of coincidences (pairs of Hits) or HitTable of pairs of hits.
     :param filename: Name of the output file.
+    :param binary: If true, a binary .npy file with a structured array is written instead (columns as in
+    GOJA_COLUMNS), which can be read back with read_goja_output.
+    :param append: If true, rows are added at the end of an existing text file.
     :return: nothing
     """
-    with open(filename, 'w') as f:
-        for coinc in coincidences:
-            if len(coinc) < 2:
-                raise Exception("A coincidence provided with less than two hits!")
-            h1 = coinc[0]
-            h2 = coinc[1]
-            line = np.array([h1.posX/10.0, h1.posY/10.0, h1.posZ/10.0, h1.time*10**12, \
-                            h2.posX/10.0, h2.posY/10.0, h2.posZ/10.0, h2.time*10**12,\
-                        h1.volumeID[1], h2.volumeID[1], h1.edep*1000, h2.edep*1000,\
-                         h1.coincType.value, h1.sourcePosX/10.0, h1.sourcePosY/10.0, h1.sourcePosZ/10.0])
-            fmt = '%.2f\t%.2f\t%.2f\t%.1f\t%.2f\t%.2f\t%.2f\t%.1f\t%.1f\t%.1f\t%.2f\t%.2f\t%d\t%.2f\t%.2f\t%.2f'
-            np.savetxt(f, line.reshape(1, line.shape[0]), fmt)
+    if binary and append:
+        raise Exception("Rows can not be appended to binary GOJA output!")
+    with instrumentation.stage('goja output') as stage:
+        rows = goja_rows(coincidences)
+        stage.n_items = len(rows)
+        if binary:
+            data = np.zeros(len(rows), dtype=[(name, np.float64) for name in GOJA_COLUMNS])
+            for ii, name in enumerate(GOJA_COLUMNS):
+                data[name] = rows[:, ii]
+            with open(filename, 'wb') as f:
+                np.save(f, data)
+            return
+        with open(filename, 'a' if append else 'w') as f:
+            for start in range(0, len(rows), GOJA_CHUNK_ROWS):
+                chunk = rows[start:start+GOJA_CHUNK_ROWS]
+                f.write((GOJA_FORMAT+'\n')*len(chunk) % tuple(chunk.ravel().tolist()))
+
+
+def read_goja_output(filename):
+    """
+    Reads GOJA-like output written by write_goja_output.
+    :param filename: Name of the text or binary (.npy) file.
+    :return: Structured array with columns named as in GOJA_COLUMNS.
+    """
+    with open(filename, 'rb') as f:
+        is_binary = f.read(6) == b'\x93NUMPY'
+    if is_binary:
+        return np.load(filename)
+    return np.loadtxt(filename, dtype=[(name, np.float64) for name in GOJA_COLUMNS], ndmin=1)
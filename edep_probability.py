@@ -3,12 +3,26 @@
 @author: Rafal Maselek
 This script creates an edep histogram to estimate the probability that a given hit originates from 511 keV annihilation process.
 """
+import argparse
 import matplotlib
 matplotlib.use('Agg')
 from mpl_toolkits.mplot3d import Axes3D
 from matplotlib import pyplot as plt
 import data_loader as dl
+import parallel_analysis as pa
+import event_cache
+from event_cache import EventCache
+from accumulators import HistogramSet
 import numpy as np
+import multiprocessing
+import probability_model
+
+# binning of edep histograms
+EDEP_BIN_NO = 200
+EDEP_RANGE = (0.0, 1.2) # [MeV]
+EDEP_LABELS = ["511_true", "511_phantom", "511_scint", "prompt_true", "prompt_phantom", "prompt_scint"]
+# branches read from simulation files
+EDEP_BRANCHES = ['edep', 'nPhantomCompton', 'nCrystalCompton']
 
 
 def save_hist(X, Y, file_name="out.txt"):
@@ -25,80 +39,138 @@ def save_hist(X, Y, file_name="out.txt"):
     np.savetxt(fname=file_name, X=arr_to_save)
 
 
-def make_histogram(file_511, file_prompt, file_name_end = "0", use_goja=False, smear=False):
-    # load date
-    events_true, phantom_scatt, detector_scatt, accidential = dl.load_data([file_511], [file_prompt], edep_cut=0.06, use_goja_event_analysis=use_goja)
-    events = events_true + phantom_scatt + detector_scatt + accidential
-
-    true_511 = []
-    phantom_511 = []
-    scintillator_511 = []
-    true_prompt = []
-    phantom_prompt = []
-    scintillator_prompt = []
-    for event in events:
-        for ii in range(len(event)):
-            if ii < 2:
-                if event[ii].nCrystalCompton == 1:
-                    if event[ii].nPhantomCompton == 0:
-                        true_511.append(event[ii].edep)
-                    else:
-                        phantom_511.append(event[ii].edep)
-                else:
-                    scintillator_511.append(event[ii].edep)
-            else:
-                if event[ii].nCrystalCompton == 1:
-                    if event[ii].nPhantomCompton == 0:
-                        true_prompt.append(event[ii].edep)
-                    else:
-                        phantom_prompt.append(event[ii].edep)
-                else:
-                    scintillator_prompt.append(event[ii].edep)
-    binNo = 200
-    total_count_no = len(true_511) + len(phantom_511) + len(scintillator_511) + len(true_prompt) + len(phantom_prompt) + len(scintillator_prompt)
-    bin_width = 1.2 / float(binNo)
-    edep = [true_511, phantom_511, scintillator_511, true_prompt, phantom_prompt, scintillator_prompt]
-    labels = ["511_true", "511_phantom", "511_scint", "prompt_true", "prompt_phantom", "prompt_scint"]
+def edep_categories(hits_511, hits_prompt):
+    """
+    Sorts deposited energies of hits into six categories: true, phantom-scattered and scintillator-scattered hits of
+    511 keV and prompt gammas.
+    :param hits_511: HitTable of pairs of annihilation hits.
+    :param hits_prompt: HitTable of prompt hits.
+    :return: List of six arrays of deposited energies, in the order of EDEP_LABELS.
+    """
+    edep = []
+    for hits in (hits_511, hits_prompt):
+        single_crystal_compton = hits.nCrystalCompton == 1
+        no_phantom_compton = hits.nPhantomCompton == 0
+        edeps = hits.edep.astype(np.float64)
+        edep.append(edeps[single_crystal_compton & no_phantom_compton])
+        edep.append(edeps[single_crystal_compton & ~no_phantom_compton])
+        edep.append(edeps[~single_crystal_compton])
+    return edep
 
-    # experiment-derived smearing
-    new_edep = []
-    if smear:
-        for arr in edep:
-            new_arr = []
-            w = []
-            for em in arr:
-                new_em = np.random.normal(em, 0.044*np.sqrt(em))
-                if new_em < 0.0:
-                    new_em = 0.0
-                new_arr.append(new_em)
-            new_edep.append(new_arr)
-        edep = new_edep
-    # printing some info
-    print("Width of single bin: {}".format(bin_width))
-    print("Sum of all entries: {}".format(total_count_no))
-    for ii in range(len(labels)):
-        print(labels[ii]+": {}".format(len(edep[ii])))
-    # making the histogram
-    weights = [np.ones_like(np.array(edep_arr))/float(total_count_no) for edep_arr in edep]
-    distr, bins, trash = plt.hist(edep, binNo, (0.0, 1.2), histtype='step', fill=False, stacked=False, normed=False, label=labels, weights=weights)
-
-    print("PDF INTEGRAL = {}".format(sum([sum(x) for x in distr])))
-    true_511_pdf = distr[0]
-    print("PDF INTEGRAL FOR TRUE 511 KEV= {}".format(sum(true_511_pdf)))
+
+def smear_edeps(edep, seed=None):
+    """
+    Applies experiment-derived energy resolution to deposited energies, with a single call of the random number
+    generator for all of them. Negative energies are set to 0.
+    :param edep: List of arrays of deposited energies [MeV].
+    :param seed: Seed of the random number generator.
+    :return: List of arrays of smeared energies.
+    """
+    sizes = [len(arr) for arr in edep]
+    energies = np.concatenate(edep) if len(edep) > 0 else np.zeros(0)
+    smeared = np.maximum(np.random.RandomState(seed).normal(energies, 0.044*np.sqrt(energies)), 0.0)
+    return np.split(smeared, np.cumsum(sizes)[:-1])
+
+
+def plot_edep_histograms(distr, bins, file_name_end="0"):
+    """
+    Plots histograms made by edep_histograms.
+    :return: nothing
+    """
+    plt.clf()
+    for hist, label in zip(distr, EDEP_LABELS):
+        plt.hist(bins[:-1], bins, weights=hist, histtype='step', fill=False, label=label)
     plt.legend(loc='upper right')
     plt.title("Deposited energy spectra, normalized as PDF")
     plt.xlabel("deposited energy [MeV]")
     plt.ylabel("probability density [1]")
     plt.savefig("results/edep_hist_norm"+file_name_end+".png")
+
+
+def count_edep_histograms(task):
+    """
+    Fills edep histograms with hits from one pair of files. It is executed by worker processes.
+    :param task: Tuple: 511 keV file name, prompt file name, use_goja, smear, seed (or None), cache directory (or None).
+    :return: HistogramSet object with raw counts, in the order of EDEP_LABELS.
+    """
+    file_511, file_prompt, use_goja, smear, seed, cache_dir = task
+    cache = None if cache_dir is None else EventCache(cache_dir)
+    hits_511, hits_prompt = dl.load_event_tables([file_511], [file_prompt], edep_cut=0.06,
+                                                 use_goja_event_analysis=use_goja, cache=cache,
+                                                 columns=EDEP_BRANCHES)
+    edep = edep_categories(hits_511, hits_prompt)
+    # experiment-derived smearing
+    if smear:
+        edep = smear_edeps(edep, seed)
+    histograms = HistogramSet(np.linspace(EDEP_RANGE[0], EDEP_RANGE[1], EDEP_BIN_NO+1), len(EDEP_LABELS))
+    for ii, arr in enumerate(edep):
+        histograms.fill(ii, arr)
+    return histograms
+
+
+def make_histograms(file_pairs, use_goja=False, smear=False, seed=None, n_processes=1, cache_dir=None):
+    """
+    Makes edep histograms of hits from many pairs of files. Raw counts of every pair are computed in a separate task of
+    a process pool, merged, and normalized as PDF at the end.
+    :param file_pairs: List of tuples (511 keV file name, prompt file name).
+    :param use_goja: If true, GOJA-like analysis is performed.
+    :param smear: If true, experiment-derived energy resolution is applied.
+    :param seed: Seed of the random number generator used for smearing, every pair of files uses a different seed
+    derived from it.
+    :param n_processes: Number of worker processes, 1 means that everything is done in the current process.
+    :param cache_dir: Directory of event_cache.EventCache with selected hits, None to disable caching.
+    :return: Array of histograms of shape (6, 200) and array of bin edges.
+    """
+    tasks = [(file_511, file_prompt, use_goja, smear, None if seed is None else [seed, ii], cache_dir)
+             for ii, (file_511, file_prompt) in enumerate(file_pairs)]
+    results = pa._run_pool(tasks, count_edep_histograms, n_processes)
+    histograms = HistogramSet(np.linspace(EDEP_RANGE[0], EDEP_RANGE[1], EDEP_BIN_NO+1), len(EDEP_LABELS))
+    for result in results:
+        histograms.merge(result)
+    # printing some info
+    print("Width of single bin: {}".format((EDEP_RANGE[1]-EDEP_RANGE[0]) / float(EDEP_BIN_NO)))
+    print("Sum of all entries: {}".format(histograms.n_entries))
+    for ii in range(len(EDEP_LABELS)):
+        print(EDEP_LABELS[ii]+": {}".format(histograms.entries[ii]))
+    distr = histograms.normalized()
+    print("PDF INTEGRAL = {}".format(distr.sum()))
+    print("PDF INTEGRAL FOR TRUE 511 KEV= {}".format(distr[0].sum()))
+    return distr, histograms.edges
+
+
+def make_histogram(file_511, file_prompt, file_name_end = "0", use_goja=False, smear=False, seed=None, plot=True):
+    """
+    Makes edep histograms of hits of 511 keV and prompt gammas from a single pair of files, normalized as PDF.
+    :param file_511: Name of the file with 511 keV data.
+    :param file_prompt: Name of the file with prompt data.
+    :param file_name_end: Suffix of the name of the plot.
+    :param use_goja: If true, GOJA-like analysis is performed.
+    :param smear: If true, experiment-derived energy resolution is applied.
+    :param seed: Seed of the random number generator used for smearing.
+    :param plot: If true, histograms are plotted.
+    :return: Array of histograms of shape (6, 200) and array of bin edges.
+    """
+    distr, bins = make_histograms([(file_511, file_prompt)], use_goja, smear, seed)
+    if plot:
+        plot_edep_histograms(distr, bins, file_name_end)
     return distr, bins
-    #plt.show()
-
-# plt.clf()
-# distr, bins = make_histogram("data/NEMA/anni50.root", "data/NEMA/prompt50.root", str(50), True, False)
-# save_hist(bins, distr, "histogram.txt")
-folder511 = "data/nema511_1_res/"
-folder_prompt = "data/nemaprompt_1_res/"
-for ii in range(50, 101, 55):
-    plt.clf()
-    distr, bins = make_histogram(folder511+"anni{}".format(ii)+".root", folder_prompt+"prompt{}".format(ii)+".root", str(ii), False, False)
-    save_hist(bins, distr, "histogram.txt")
\ No newline at end of file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Makes edep histograms of 511 keV and prompt hits.')
+    event_cache.add_cache_argument(parser)
+    args = parser.parse_args()
+    folder511 = "data/nema511_1_res/"
+    folder_prompt = "data/nemaprompt_1_res/"
+    # True to analyze detector-scattered and accidental hits, remember to save to histogramGOJA.txt then
+    use_goja = False
+    smear = False
+    # all files of the campaign are used, one task per pair of files
+    file_pairs = [(folder511+"anni{}".format(ii)+".root", folder_prompt+"prompt{}".format(ii)+".root")
+                  for ii in range(1, 101)]
+    n_processes = multiprocessing.cpu_count()
+    distr, bins = make_histograms(file_pairs, use_goja, smear, n_processes=n_processes, cache_dir=args.cache)
+    plot_edep_histograms(distr, bins, "_all")
+    file_name = "histogramGOJA" if use_goja else "histogram"
+    save_hist(bins, distr, file_name+".txt")
+    probability_model.load_model(file_name+".txt").save(file_name+".npz")
@@ -0,0 +1,205 @@
+"""
+@author: Rafal Maselek
+This file contains a persistent cache of hits selected from simulation files. Selections are stored in binary .npz
+files, one per input file and set of cuts, so that later runs do not have to read ROOT files again.
+"""
+import hashlib
+import inspect
+import json
+import marshal
+import os
+import data_loader as dl
+
+DEFAULT_CACHE_DIR = "cache"
+# default limit of the total size of cached selections [bytes]
+DEFAULT_SIZE_LIMIT = 20 * 1024**3
+# functions and C++ code selecting hits; their source is a part of the key of cache entries, so that selections cached
+# by an older version of the code are not used
+SELECTION_CODE = [dl.COMPTON_PROCESS_CODE, dl.is_compton_process, dl.proper_hit_mask, dl.hit_cuts, dl.event_starts,
+                  dl.select_coincidences, dl.last_event_start, dl.read_hits, dl.branch_arrays, dl.selected_branches,
+                  dl.iter_file_coincidences, dl.iter_file_prompts]
+
+# digest of SELECTION_CODE, calculated once per process
+_selection_digest = None
+
+
+def file_digest(file_name, block_size=2**20):
+    """
+    Calculates SHA-1 hash of the content of a file.
+    :param file_name: Name of the file.
+    :param block_size: Number of bytes read at once.
+    :return: Hex digest.
+    """
+    sha = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            sha.update(block)
+            block = f.read(block_size)
+    return sha.hexdigest()
+
+
+def selection_digest():
+    """
+    :return: Hex digest of the source code of SELECTION_CODE.
+    """
+    global _selection_digest
+    if _selection_digest is None:
+        sha = hashlib.sha1()
+        for item in SELECTION_CODE:
+            if isinstance(item, str):
+                sha.update(item.encode('utf-8'))
+                continue
+            try:
+                sha.update(inspect.getsource(item).encode('utf-8'))
+            except (IOError, OSError, TypeError):
+                # without source files the compiled code is used
+                sha.update(marshal.dumps(item.__code__))
+        _selection_digest = sha.hexdigest()
+    return _selection_digest
+
+
+def add_cache_argument(parser):
+    """
+    Adds the --cache option to a command-line parser. Caching is disabled unless the option is given, without a value
+    DEFAULT_CACHE_DIR is used.
+    :param parser: argparse.ArgumentParser object.
+    :return: nothing
+    """
+    parser.add_argument('--cache', nargs='?', const=DEFAULT_CACHE_DIR, default=None, metavar='DIR',
+                        help='directory with cached selections of hits (default: {}), caching is disabled if not '
+                             'given'.format(DEFAULT_CACHE_DIR))
+
+
+class EventCache:
+    """
+    Cache of selected hits keyed by the content of the input file, the kind of data ('511' or 'prompt'), edep_cut,
+    use_goja_event_analysis, the source code of the selection (selection_digest), dl.SELECTION_VERSION and the read
+    branches. Entries are removed in least-recently-used order when their total size exceeds the limit. The
+    modification time of an entry is used as the time of its last use, so that many processes can share one cache
+    directory without a common index file.
+    """
+    def __init__(self, directory=DEFAULT_CACHE_DIR, size_limit=DEFAULT_SIZE_LIMIT):
+        self.directory = directory
+        self.size_limit = size_limit
+        self.digest_directory = os.path.join(directory, 'digests')
+        if not os.path.isdir(self.digest_directory):
+            try:
+                os.makedirs(self.digest_directory)
+            except OSError:
+                # the directory could have been created by another process in the meantime
+                if not os.path.isdir(self.digest_directory):
+                    raise
+
+    def digest(self, file_name):
+        """
+        Returns the hash of the content of a file. Hashes are remembered together with the size and the modification
+        time of the file, so a file is read again only if it was changed.
+        :param file_name: Name of the file.
+        :return: Hex digest.
+        """
+        stat = os.stat(file_name)
+        path = os.path.abspath(file_name)
+        memo_name = os.path.join(self.digest_directory, hashlib.sha1(path.encode('utf-8')).hexdigest()+'.json')
+        signature = [stat.st_size, stat.st_mtime]
+        if os.path.isfile(memo_name):
+            with open(memo_name) as f:
+                memo = json.load(f)
+            if memo['signature'] == signature:
+                return memo['digest']
+        digest = file_digest(file_name)
+        self._write_atomic(memo_name, json.dumps({'path': path, 'signature': signature, 'digest': digest}).encode())
+        return digest
+
+    def entry_name(self, file_name, kind, edep_cut, use_goja_event_analysis, columns=dl.HIT_BRANCHES):
+        """
+        :return: Name of the cache file for given input file, selection parameters and read branches.
+        """
+        key = [self.digest(file_name), kind, repr(float(edep_cut)), bool(use_goja_event_analysis),
+               dl.SELECTION_VERSION, selection_digest()]
+        if set(columns) != set(dl.HIT_BRANCHES):
+            key.append(sorted(columns))
+        key = json.dumps(key)
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest()+'.npz')
+
+    def load(self, file_name, kind, edep_cut, use_goja_event_analysis, columns=dl.HIT_BRANCHES):
+        """
+        Loads a cached selection.
+        :param file_name: Name of the input file.
+        :param kind: '511' for coincidences from 511 keV data, 'prompt' for prompt hits.
+        :param edep_cut: Lower selection value for deposited energy.
+        :param use_goja_event_analysis: If true, GOJA-like analysis was performed.
+        :param columns: Names of the branches requested when the selection was made.
+        :return: HitTable object or None if the selection is not in the cache.
+        """
+        name = self.entry_name(file_name, kind, edep_cut, use_goja_event_analysis, columns)
+        try:
+            table = dl.HitTable.load(name)
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        os.utime(name, None)
+        print("[LOADED FROM CACHE: "+name+"]")
+        return table
+
+    def save(self, file_name, kind, edep_cut, use_goja_event_analysis, table, columns=dl.HIT_BRANCHES):
+        """
+        Stores a selection in the cache and removes the least recently used entries if the size limit is exceeded.
+        :param file_name: Name of the input file.
+        :param kind: '511' for coincidences from 511 keV data, 'prompt' for prompt hits.
+        :param edep_cut: Lower selection value for deposited energy.
+        :param use_goja_event_analysis: If true, GOJA-like analysis was performed.
+        :param table: HitTable object.
+        :param columns: Names of the branches requested when the selection was made.
+        :return: nothing
+        """
+        name = self.entry_name(file_name, kind, edep_cut, use_goja_event_analysis, columns)
+        temporary_name = '{}.{}.tmp'.format(name, os.getpid())
+        table.save(temporary_name)
+        os.rename(temporary_name, name)
+        self.evict()
+
+    def entries(self):
+        """
+        :return: List of tuples (time of last use, size, file name) of all cache entries.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the total size of the cache is below the limit.
+        :return: nothing
+        """
+        entries = sorted(self.entries())
+        total_size = sum(size for last_use, size, path in entries)
+        for last_use, size, path in entries:
+            if total_size <= self.size_limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
+
+    def clear(self):
+        """
+        Removes all entries.
+        :return: nothing
+        """
+        for last_use, size, path in self.entries():
+            os.remove(path)
+
+    @staticmethod
+    def _write_atomic(file_name, data):
+        temporary_name = '{}.{}.tmp'.format(file_name, os.getpid())
+        with open(temporary_name, 'wb') as f:
+            f.write(data)
+        os.rename(temporary_name, file_name)
@@ -0,0 +1,173 @@
+"""
+@author: Rafal Maselek
+This file contains an append-only, memory-mapped store of selected events (two annihilation hits and a prompt hit).
+Every column is kept in a separate binary file with fixed-width rows, so a stored campaign is reopened instantly and
+its columns are read as zero-copy NumPy views, shared by all processes through the page cache.
+"""
+import json
+import os
+import numpy as np
+import data_loader as dl
+
+STORE_VERSION = 1
+META_FILE = "meta.json"
+# string columns are stored as codes of this type, so that their width does not depend on the number of strings
+CODE_DTYPE = np.uint16
+# roles of hits in an event and numbers of rows per event
+ROLES = (('511', 2), ('prompt', 1))
+
+
+class EventStore:
+    """
+    Store of events in a directory. Tables returned by EventStore.tables are HitTables with memory-mapped columns.
+    Only one process may append to a store at a time, but any number of processes can read it.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        meta_name = os.path.join(directory, META_FILE)
+        if os.path.isfile(meta_name):
+            with open(meta_name) as f:
+                self.meta = json.load(f)
+            if self.meta['version'] != STORE_VERSION:
+                raise Exception("Unsupported version of the event store in "+directory+"!")
+        else:
+            self.meta = {'version': STORE_VERSION, 'n_events': 0, 'columns': None, 'categories': {}}
+        self.categories = dict((column, dl.StringCategories(names))
+                               for column, names in self.meta['categories'].items())
+
+    def __len__(self):
+        return self.meta['n_events']
+
+    def column_file(self, role, column):
+        return os.path.join(self.directory, '{}_{}.bin'.format(role, column))
+
+    def append(self, hits_511, hits_prompt):
+        """
+        Appends events to the store. Data are written to column files first and the number of events is updated at the
+        end, so readers never see partially written events.
+        :param hits_511: HitTable of pairs of annihilation hits (rows 2*i and 2*i+1 belong to the i-th event).
+        :param hits_prompt: HitTable of prompt hits of the same events.
+        :return: nothing
+        """
+        n_events = len(hits_prompt)
+        if len(hits_511) != 2*n_events:
+            raise Exception("Numbers of annihilation and prompt hits do not match!")
+        if n_events == 0:
+            return
+        if self.meta['columns'] is None:
+            self.meta['columns'] = self._column_layout(hits_511)
+        for role, rows_per_event, hits in ((ROLES[0][0], ROLES[0][1], hits_511), (ROLES[1][0], ROLES[1][1], hits_prompt)):
+            for column, layout in self.meta['columns'].items():
+                values = hits.columns[column]
+                if column in self.categories:
+                    # codes are translated into the lookup table of the store
+                    values = self.categories[column].encode(hits.categories[column].decode(values))
+                values = np.ascontiguousarray(values, dtype=layout['dtype'])
+                row_size = np.dtype(layout['dtype']).itemsize*int(np.prod(layout['shape']))
+                with open(self.column_file(role, column), 'ab') as f:
+                    # bytes left by an interrupted append are overwritten
+                    f.truncate(len(self)*rows_per_event*row_size)
+                    f.seek(0, os.SEEK_END)
+                    f.write(values.tobytes())
+        self.meta['n_events'] += n_events
+        self.meta['categories'] = dict((column, categories.names) for column, categories in self.categories.items())
+        self._write_meta()
+
+    def tables(self, start=0, stop=None):
+        """
+        Returns events as HitTables of memory-mapped columns, no data is copied.
+        :param start: Index of the first event.
+        :param stop: Index after the last event, None for all events.
+        :return: Two HitTables: pairs of annihilation hits and prompt hits.
+        """
+        n_events = len(self)
+        stop = n_events if stop is None else min(stop, n_events)
+        start = min(start, stop)
+        tables = []
+        for role, rows_per_event in ROLES:
+            columns = {}
+            for column, layout in (self.meta['columns'] or {}).items():
+                shape = tuple(layout['shape'])
+                if n_events == 0:
+                    columns[column] = np.zeros((0,)+shape, dtype=layout['dtype'])
+                    continue
+                values = np.memmap(self.column_file(role, column), dtype=layout['dtype'], mode='r',
+                                   shape=(n_events*rows_per_event,)+shape)
+                columns[column] = values[start*rows_per_event:stop*rows_per_event]
+            if len(columns) == 0:
+                tables.append(dl.HitTable.empty())
+            else:
+                tables.append(dl.HitTable(columns, self._table_categories()))
+        return tables[0], tables[1]
+
+    def iter_tables(self, chunk_events=dl.DEFAULT_CHUNK_EVENTS):
+        """
+        :param chunk_events: Maximal number of events in a chunk.
+        :return: Generator of tuples of two HitTables (views of the store), like dl.iter_event_tables.
+        """
+        for start in range(0, len(self), chunk_events):
+            yield self.tables(start, start+chunk_events)
+
+    def events(self, start=0, stop=None):
+        """
+        Returns events for plotters, like dl.load_data. Hits are HitViews of memory-mapped tables.
+        :param start: Index of the first event.
+        :param stop: Index after the last event, None for all events.
+        :return: Four lists of events: true, phantom-scattered, detector-scattered, accidental.
+        """
+        return dl.group_events(*self.tables(start, stop))
+
+    def lor_batch(self, histograms=[], start=0, stop=None):
+        """
+        Finds LORs of stored events.
+        :param histograms: ProbabilityModel object or edep histograms used to calculate probabilities.
+        :param start: Index of the first event.
+        :param stop: Index after the last event, None for all events.
+        :return: LorBatch object and array of coincidence types of events.
+        """
+        positions, edeps, coinc_types = dl.table_event_arrays(*self.tables(start, stop))
+        return dl.lor_batch_from_arrays(positions, edeps, coinc_types, histograms), coinc_types
+
+    def _table_categories(self):
+        # tables get their own copy, so that encoding new strings in a table does not change the store
+        return dict((column, dl.StringCategories(categories.names)) for column, categories in self.categories.items())
+
+    def _column_layout(self, hits):
+        layout = {}
+        for column, values in hits.columns.items():
+            if column in hits.categories:
+                self.categories.setdefault(column, dl.StringCategories())
+                dtype = np.dtype(CODE_DTYPE)
+            else:
+                dtype = values.dtype
+            layout[column] = {'dtype': dtype.str, 'shape': list(values.shape[1:])}
+        return layout
+
+    def _write_meta(self):
+        meta_name = os.path.join(self.directory, META_FILE)
+        temporary_name = '{}.{}.tmp'.format(meta_name, os.getpid())
+        with open(temporary_name, 'w') as f:
+            json.dump(self.meta, f)
+        os.rename(temporary_name, meta_name)
+
+
+def build_store(directory, file_list_511, file_list_prompt, edep_cut=0.06, use_goja_event_analysis=False,
+                cache=None):
+    """
+    Selects events from files and appends them to a store, chunk by chunk.
+    :param directory: Directory of the store.
+    :param file_list_511: List of files of 511 keV data.
+    :param file_list_prompt: List of files of prompt data.
+    :param edep_cut: Lower selection value for deposited energy.
+    :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
+    :param cache: Optional event_cache.EventCache object.
+    :return: EventStore object.
+    """
+    store = EventStore(directory)
+    for hits_511, hits_prompt in dl.iter_event_tables(file_list_511, file_list_prompt, edep_cut,
+                                                      use_goja_event_analysis, cache=cache):
+        store.append(hits_511, hits_prompt)
+    print('[NO OF EVENTS IN STORE {}: {}]'.format(directory, len(store)))
+    return store
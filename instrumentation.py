@@ -0,0 +1,239 @@
+"""
+@author: Rafal Maselek
+This file contains instrumentation of the analysis: timers of stages, numbers of processed items (throughput) and
+numbers of hits rejected by every selection cut. It is disabled by default; when disabled, every call returns
+immediately, so instrumented code runs at full speed.
+Usage:
+    instrumentation.enable()
+    ... analysis ...
+    instrumentation.current().save("results/metrics.json")
+"""
+import json
+import time
+
+
+class _NullStage:
+    """
+    Stage timer used when instrumentation is disabled, it does nothing.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """
+    Context manager adding the time spent inside of it to a stage.
+    """
+    def __init__(self, metrics, name, n_items):
+        self.metrics = metrics
+        self.name = name
+        self.n_items = n_items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.add_time(self.name, time.perf_counter()-self.start, self.n_items)
+        return False
+
+
+class Instrumentation:
+    """
+    Metrics of a single run: for every stage the total time, the number of calls and the number of processed items,
+    general counters and cut flows (numbers of hits rejected by consecutive cuts).
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {}
+        self.counters = {}
+        self.cuts = {}
+
+    def stage(self, name, n_items=0):
+        """
+        Returns a context manager measuring the time of a stage.
+        :param name: Name of the stage.
+        :param n_items: Number of items (hits, events, LORs...) processed inside of the context.
+        :return: Context manager.
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name, n_items)
+
+    def add_time(self, name, seconds, n_items=0):
+        """
+        Adds time and items to a stage.
+        :return: nothing
+        """
+        if not self.enabled:
+            return
+        stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'items': 0})
+        stage['seconds'] += seconds
+        stage['calls'] += 1
+        stage['items'] += int(n_items)
+
+    def count(self, name, n=1):
+        """
+        Increases a counter.
+        :return: nothing
+        """
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def cut_flow(self, name, cuts):
+        """
+        Counts hits rejected by consecutive cuts, every hit is counted only by the first cut it fails.
+        :param name: Name of the selection.
+        :param cuts: List of tuples (name of the cut, boolean array true for hits passing the cut).
+        :return: nothing
+        """
+        if not self.enabled or len(cuts) == 0:
+            return
+        rejected = []
+        passed = None
+        for cut_name, mask in cuts:
+            if passed is None:
+                n_input = len(mask)
+                rejected.append((cut_name, len(mask) - int(mask.sum())))
+                passed = mask
+            else:
+                rejected.append((cut_name, int((passed & ~mask).sum())))
+                passed = passed & mask
+        self.cut_counts(name, n_input, rejected)
+
+    def cut_counts(self, name, n_input, rejected):
+        """
+        Same as cut_flow, but for cuts already counted elsewhere, e.g. by filters of the tree reader.
+        :param name: Name of the selection.
+        :param n_input: Number of hits before the first cut.
+        :param rejected: List of tuples (name of the cut, number of hits rejected by it) in the order of cuts.
+        :return: nothing
+        """
+        if not self.enabled:
+            return
+        flow = self.cuts.setdefault(name, {'input': 0, 'passed': 0, 'rejected': {}})
+        flow['input'] += int(n_input)
+        for cut_name, n_rejected in rejected:
+            flow['rejected'][cut_name] = flow['rejected'].get(cut_name, 0) + int(n_rejected)
+        flow['passed'] += int(n_input) - sum(int(n_rejected) for cut_name, n_rejected in rejected)
+
+    def merge(self, other):
+        """
+        Adds metrics of another run, e.g. of a worker process.
+        :param other: Instrumentation object.
+        :return: self
+        """
+        for name, stage in other.stages.items():
+            mine = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'items': 0})
+            for key in mine:
+                mine[key] += stage[key]
+        for name, n in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + n
+        for name, flow in other.cuts.items():
+            mine = self.cuts.setdefault(name, {'input': 0, 'passed': 0, 'rejected': {}})
+            mine['input'] += flow['input']
+            mine['passed'] += flow['passed']
+            for cut_name, n in flow['rejected'].items():
+                mine['rejected'][cut_name] = mine['rejected'].get(cut_name, 0) + n
+        return self
+
+    def to_dict(self):
+        """
+        :return: Dictionary with all metrics, throughput of stages is calculated in items per second.
+        """
+        stages = {}
+        for name, stage in self.stages.items():
+            stages[name] = dict(stage)
+            stages[name]['throughput'] = stage['items']/stage['seconds'] if stage['seconds'] > 0 else 0.0
+        return {'stages': stages, 'counters': dict(self.counters), 'cuts': self.cuts}
+
+    def save(self, filename):
+        """
+        Saves metrics to a JSON file.
+        :param filename: Name of the output file.
+        :return: nothing
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+        print('[METRICS SAVED TO '+filename+']')
+
+    def report(self):
+        """
+        Prints times of stages and cut flows.
+        :return: nothing
+        """
+        for name, stage in sorted(self.to_dict()['stages'].items(), key=lambda item: -item[1]['seconds']):
+            print('[{}: {:.3f} s IN {} CALLS, {} ITEMS, {:.0f} ITEMS/S]'.format(name.upper(), stage['seconds'],
+                                                                              stage['calls'], stage['items'],
+                                                                              stage['throughput']))
+        for name, flow in sorted(self.cuts.items()):
+            print('[{}: {} INPUT, {} PASSED, REJECTED: {}]'.format(name.upper(), flow['input'], flow['passed'],
+                                                                  ', '.join('{}={}'.format(cut_name, n) for cut_name, n
+                                                                            in flow['rejected'].items())))
+
+
+# metrics of the current run, disabled until enable() is called
+_current = Instrumentation(enabled=False)
+
+
+def current():
+    """
+    :return: Instrumentation object collecting metrics of the current run.
+    """
+    return _current
+
+
+def use(metrics):
+    """
+    Replaces the object collecting metrics.
+    :param metrics: Instrumentation object.
+    :return: Previously used Instrumentation object.
+    """
+    global _current
+    previous = _current
+    _current = metrics
+    return previous
+
+
+def enable():
+    """
+    Starts collecting metrics in a new Instrumentation object.
+    :return: The new Instrumentation object.
+    """
+    use(Instrumentation(enabled=True))
+    return _current
+
+
+def disable():
+    """
+    Stops collecting metrics.
+    :return: nothing
+    """
+    _current.enabled = False
+
+
+def enabled():
+    return _current.enabled
+
+
+def stage(name, n_items=0):
+    return _current.stage(name, n_items)
+
+
+def count(name, n=1):
+    _current.count(name, n)
+
+
+def cut_flow(name, cuts):
+    _current.cut_flow(name, cuts)
+
+
+def cut_counts(name, n_input, rejected):
+    _current.cut_counts(name, n_input, rejected)
@@ -5,19 +5,24 @@ This script analysis lors: it selects true lors and organizes them by their dist
 three lors
 """
 from __future__ import print_function
+import argparse
 import matplotlib
 matplotlib.use('Agg')
 from mpl_toolkits.mplot3d import Axes3D
 from matplotlib import pyplot as plt
-import data_loader as dl
 import plotter
 import classification as cf
+import parallel_analysis as pa
+import event_cache
+import instrumentation
 import numpy as np
 import math
-from main import *
+import multiprocessing
+from main import prepare_fname_lists
 
 
-def analyse_lors(files_511, files_prompt, goja_event_analysis, loop_step):
+def analyse_lors(files_511, files_prompt, goja_event_analysis, loop_step, nloops, short_run=False, edep_cut=0.06,
+                 n_processes=1, cache_dir=None):
     """
     Counts the number of true lors that have the smallest distance from the origin out of three, or the highest distance, 
     or not the smallest nor the highest (middle one).
@@ -25,31 +30,31 @@ def analyse_lors(files_511, files_prompt, goja_event_analysis, loop_step):
     :param files_prompt: List of strings with file names of files with prompt data or single string in case of a single file.
     :param goja_event_analysis: If true, GOJA-like analysis will be performed.
     :param loop_step: Loop step. E.g. if it is equal to 5, one out of 5 files will be analyzed.
+    :param nloops: Number of files.
+    :param short_run: If true, only the last file is analysed in every step.
+    :param edep_cut: Lower selection value for deposited energy.
+    :param n_processes: Number of worker processes analysing files in parallel.
+    :param cache_dir: Directory with cached selections of hits, None to disable caching.
     :return: Arrays d_min, d_mid, d_max containing numbers of lors in given category. Each entry corresponds to different
     file.
     """
-    d_min = []
-    d_mid = []
-    d_max = []
+    file_pairs = []
     for nn in range(0, nloops, loop_step):
         if short_run:
-            events_true, phantom_scatt, detector_scatt, accidential = dl.load_data([files_511[-1]],
-                                                                                   [files_prompt[-1]], edep_cut,
-                                                                                   goja_event_analysis)
+            file_pairs.append(([files_511[-1]], [files_prompt[-1]]))
         elif nloops > 1:
-            events_true, phantom_scatt, detector_scatt, accidential = dl.load_data([files_511[nn]],
-                                                                                   [files_prompt[nn]], edep_cut,
-                                                                                   goja_event_analysis)
+            file_pairs.append(([files_511[nn]], [files_prompt[nn]]))
         else:
-            events_true, phantom_scatt, detector_scatt, accidential = dl.load_data(files_511, files_prompt,
-                                                                                   edep_cut, goja_event_analysis)
-        # event_check(events)
-
-        events = events_true + phantom_scatt
-        print(len(events_true), ' ', len(phantom_scatt), ' ', len(events))
-
-        lors, lors_from_annihilation, lors_with_prompt, lors_true_anni = dl.find_lors(events)
-        d1, d2, d3 = dl.count_sorted_lors(lors)
+            file_pairs.append((files_511, files_prompt))
+    # every pair of files is analysed by a separate worker process
+    results = pa.analyse_files(file_pairs, edep_cut, goja_event_analysis, n_processes=n_processes,
+                               cache_dir=cache_dir)
+    d_min = []
+    d_mid = []
+    d_max = []
+    for result in results:
+        print(result.n_events)
+        d1, d2, d3 = result.fractions.fractions()
         d_min.append(d1)
         d_mid.append(d2)
         d_max.append(d3)
@@ -58,35 +63,49 @@ def analyse_lors(files_511, files_prompt, goja_event_analysis, loop_step):
 #######################################################################################################################
 #######################################################################################################################
 #######################################################################################################################
-# SCRIPT PARAMETERS #
-print('[START]')
-edep_cut = 0.06
-short_run = False 
-goja_event_analysis = False
-nloops = 100
-data_folder = "data/NEMA"
-loop_step = 10
-
-nloops2 = 100
-data_folder2 = "data/NEMA"
-use_second_data = True # if yes, then second set of data will be analyzed and plotted on the same plot
-loop_step2 = 10
-# LOADING DATA #
-file_list_511, file_list_prompt = prepare_fname_lists("anni", "prompt", data_folder, nloops)
-dmin1, dmid1, dmax1 = analyse_lors(file_list_511, file_list_prompt, goja_event_analysis, loop_step)
-# Loading and analyzing second set of data
-if use_second_data:
-    file_list_511, file_list_prompt = prepare_fname_lists("anni", "prompt", data_folder2, nloops2)
-    dmin2, dmid2, dmax2 = analyse_lors(file_list_511, file_list_prompt, goja_event_analysis, loop_step2)
+if __name__ == "__main__":
+    # SCRIPT PARAMETERS # (a study with all analyses in a single pass over the data can be run with scheduler.py)
+    parser = argparse.ArgumentParser(description='Fractions of LORs in ranges of d as a function of the number of files.')
+    event_cache.add_cache_argument(parser)
+    args = parser.parse_args()
+    print('[START]')
+    edep_cut = 0.06
+    short_run = False 
+    goja_event_analysis = False
+    nloops = 100
+    data_folder = "data/NEMA"
+    loop_step = 10
+    # number of worker processes analysing files in parallel
+    n_processes = multiprocessing.cpu_count()
+    # directory with cached selections of hits, given by the --cache option
+    cache_dir = args.cache
+    # file with times of stages and numbers of rejected hits, None to disable instrumentation
+    metrics_file = "results/metrics.json"
+    if metrics_file is not None:
+        instrumentation.enable()
 
-# DRAWING PLOT(S) #
-if nloops > 1:
-    r =range(1, nloops+1, loop_step)
+    nloops2 = 100
+    data_folder2 = "data/NEMA"
+    use_second_data = True # if yes, then second set of data will be analyzed and plotted on the same plot
+    loop_step2 = 10
+    # LOADING DATA #
+    file_list_511, file_list_prompt = prepare_fname_lists("anni", "prompt", data_folder, nloops)
+    dmin1, dmid1, dmax1 = analyse_lors(file_list_511, file_list_prompt, goja_event_analysis, loop_step, nloops,
+                                       short_run, edep_cut, n_processes, cache_dir)
+    # Loading and analyzing second set of data
     if use_second_data:
-        r2 = range(1, nloops + 1, loop_step2)
-        plotter.plot_lors_fractions2(dmin1, dmid1, dmax1, r, dmin2, dmid2, dmax2, r2)
-    else:
-        plotter.plot_lors_fractions(dmin1, dmid1, dmax1, r, filename="fractions_of_lors")
-
-
+        file_list_511, file_list_prompt = prepare_fname_lists("anni", "prompt", data_folder2, nloops2)
+        dmin2, dmid2, dmax2 = analyse_lors(file_list_511, file_list_prompt, goja_event_analysis, loop_step2, nloops2,
+                                           short_run, edep_cut, n_processes, cache_dir)
 
+    # DRAWING PLOT(S) #
+    if nloops > 1:
+        r =range(1, nloops+1, loop_step)
+        if use_second_data:
+            r2 = range(1, nloops + 1, loop_step2)
+            plotter.plot_lors_fractions2(dmin1, dmid1, dmax1, r, dmin2, dmid2, dmax2, r2)
+        else:
+            plotter.plot_lors_fractions(dmin1, dmid1, dmax1, r, filename="fractions_of_lors")
+    if metrics_file is not None:
+        instrumentation.current().report()
+        instrumentation.current().save(metrics_file)
@@ -1,63 +1,84 @@
 #!/bin/python2.7
 """
 @author: Rafal Maselek
-This script conducts simple binary classification for one of the two hypothesis:
-1) LOR with greatest possibility to be true is true
-2) LOR with greatest possibility to contain one prompt and one 511 keV is false
+This script conducts simple binary classification with all decision rules registered in classification.py, in a single
+run:
+1) LOR with greatest possibility to be true is true ('511')
+2) LOR with greatest possibility to contain one prompt and one 511 keV is false ('prompt')
+3) the sophisticated classifier ('sophisticated')
 """
+import argparse
 import plotter
-import data_loader as dl
 import classification as cf
-import numpy as np
-import timeit
+import parallel_analysis as pa
+import event_cache
+import probability_model
+import instrumentation
+import multiprocessing
 
-folder511 = "data/NEMA/"
-folder_prompt = "data/NEMA/"
-# lower cut on edep
-edep_cut = 0.06
-# True to analyze detector-scattered and accidental hits
-goja_event_analysis = True
-# If False, hypothesis 1) is used, otherwise 2)
-use_prompt = False
-# loop step sets the number of files that will be used (by default from range [1,101) )
-loop_step = 8
-# use sophisticated classificator
-sophisticated = True
-#name of the output file
-filename = "lors_class_sophi_GOJA.png"
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Binary classification of LORs with all decision rules.')
+    event_cache.add_cache_argument(parser)
+    parser.add_argument('--edep-cuts', type=float, nargs='+', default=[0.06], metavar='CUT',
+                        help='lower cuts on edep, many cuts are analysed with a single load of every file')
+    args = parser.parse_args()
+    folder511 = "data/NEMA/"
+    folder_prompt = "data/NEMA/"
+    # lower cuts on edep, given by the --edep-cuts option
+    edep_cuts = args.edep_cuts
+    # True to analyze detector-scattered and accidental hits
+    goja_event_analysis = True
+    # loop step sets the number of files that will be used (by default from range [1,101) )
+    loop_step = 8
+    # names of the output files, {} is replaced with the name of a decision rule (and the cut if there are many)
+    filename = "lors_class_{}_GOJA.png"
+    # number of worker processes analysing files in parallel
+    n_processes = multiprocessing.cpu_count()
+    # directory with cached selections of hits, given by the --cache option
+    cache_dir = args.cache
+    # file with times of stages and numbers of rejected hits, None to disable instrumentation
+    metrics_file = "results/metrics.json"
+    if metrics_file is not None:
+        instrumentation.enable()
 
-TPR = []
-FPR = []
-PPV = []
-SPC = []
-
-for ii in range(1, 100, loop_step):
-    events_true, phantom_scatt, detector_scatt, accidential = dl.load_data([folder511+"anni{}".format(ii)+".root"],
-                                                                           [folder_prompt+"prompt{}".format(ii)+".root"],
-                                                                           edep_cut,
-                                                                           goja_event_analysis)
-    events = events_true+phantom_scatt+detector_scatt+accidential
     # name of the histogram file, remeber to use proper file for GOJA-like and non-GOJA analysis!
+    # binary models (.npz, see probability_model.py) are loaded faster than text histograms
     if goja_event_analysis:
-        histograms = np.loadtxt("histogramGOJA.txt")
+        histograms = probability_model.load_model("histogramGOJA.txt")
     else:
-        histograms = np.loadtxt("histogram.txt")
-    lors, lors_from_annihilation, lors_with_prompt, lors_true_anni = dl.find_lors(events, histograms, verbose=False)
-    lors_pairs = cf.remove_farthest_lor(lors)
-    if sophisticated:
-        tpr, spc, ppv, fpr = cf.binary_classification_probability_sophisticated(lors_pairs, verbose=False)
+        histograms = probability_model.load_model("histogram.txt")
+    file_pairs = [(folder511+"anni{}".format(ii)+".root", folder_prompt+"prompt{}".format(ii)+".root")
+                  for ii in range(1, 100, loop_step)]
+    if len(edep_cuts) == 1:
+        cut_results = [pa.analyse_files(file_pairs, edep_cuts[0], goja_event_analysis, histograms, n_processes,
+                                        cache_dir=cache_dir)]
     else:
-        tpr, spc, ppv, fpr = cf.binary_classification_probability(lors_pairs, use_prompt=use_prompt, verbose=False)
-    print("[CLASSIFICATION: TPR={} SPC={} PPV={} FPR={}]".format(tpr, spc, ppv, fpr))
-    TPR.append(tpr)
-    SPC.append(spc)
-    PPV.append(ppv)
-    FPR.append(fpr)
-
-r = range(1, 100, loop_step)
-print("ALL VALUES:")
-print("TPR: ",TPR)
-print("PPV: ",PPV)
-print("SPC: ",SPC)
-print("FPR: ",FPR)
-plotter.plot_classification_plots(TPR, PPV, FPR, r, filename)
+        # every file is loaded once for all cuts, results of a file are listed in the order of edep_cuts
+        file_results = pa.sweep_files(file_pairs, edep_cuts, goja_event_analysis, histograms, n_processes)
+        cut_results = [[results[ii] for results in file_results] for ii in range(len(edep_cuts))]
+    r = range(1, 100, loop_step)
+    for edep_cut, results in zip(edep_cuts, cut_results):
+        # all decision rules were evaluated on the same LORs
+        for classifier in cf.DECISION_RULES:
+            TPR = []
+            FPR = []
+            PPV = []
+            SPC = []
+            for result in results:
+                tpr, spc, ppv, fpr = result.classification[classifier].coefficients()
+                print("[EDEP CUT {}: CLASSIFICATION {}: TPR={} SPC={} PPV={} FPR={}]".format(
+                    edep_cut, classifier.upper(), tpr, spc, ppv, fpr))
+                TPR.append(tpr)
+                SPC.append(spc)
+                PPV.append(ppv)
+                FPR.append(fpr)
+            print("ALL VALUES ({}, EDEP CUT {}):".format(classifier, edep_cut))
+            print("TPR: ",TPR)
+            print("PPV: ",PPV)
+            print("SPC: ",SPC)
+            print("FPR: ",FPR)
+            name = classifier if len(edep_cuts) == 1 else "{}_edep{}".format(classifier, edep_cut)
+            plotter.plot_classification_plots(TPR, PPV, FPR, r, filename.format(name))
+    if metrics_file is not None:
+        instrumentation.current().report()
+        instrumentation.current().save(metrics_file)
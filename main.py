@@ -4,9 +4,13 @@
 Main file of the scipt package
 """
 from __future__ import print_function
+import argparse
 import plotter
 import data_loader as dl
 import classification as cf
+import event_cache
+from event_cache import EventCache
+from probability_model import load_model
 import numpy as np
 import math
 
@@ -54,9 +58,10 @@ def prepare_fname_lists(annihilation_fname, prompt_fname, folder, N):
         file_list_prompt.append(folder+"/"+prompt_fname+"{}".format(ii)+".root")
     return file_list_511, file_list_prompt
 
-def main():
+def main(cache_dir=None):
     """
     Main function of the program.
+    :param cache_dir: Directory with cached selections of hits, None to disable caching.
     :return: nothing
     """
     print('[START]')
@@ -67,19 +72,23 @@ def main():
     edep_cut = 0.06
     short_run = True # Set True if using only one file for each type of data. Otherwise set False and data from all files will be loaded.
     goja_event_analysis = True
+    # selected hits are stored in the cache directory and reused by later runs
+    cache = None if cache_dir is None else EventCache(cache_dir)
     file_list_511 = [data_folder_511+'/'+name for name in file_list_511]
     file_list_prompt = [data_folder_prompt+'/'+name for name in file_list_prompt]
 
     if(short_run):
-        events_true, phantom_scatt, detector_scatt, accidential = dl.load_data([file_list_511[-1]], [file_list_prompt[-1]], edep_cut, goja_event_analysis)
+        events_true, phantom_scatt, detector_scatt, accidential = dl.load_data([file_list_511[-1]], [file_list_prompt[-1]], edep_cut, goja_event_analysis,
+                                                                               cache=cache)
     else:
-        events_true, phantom_scatt, detector_scatt, accidential = dl.load_data(file_list_511, file_list_prompt, edep_cut, goja_event_analysis)
+        events_true, phantom_scatt, detector_scatt, accidential = dl.load_data(file_list_511, file_list_prompt, edep_cut, goja_event_analysis,
+                                                                               cache=cache)
     # event_check(events)
 
     events = events_true+phantom_scatt+detector_scatt+accidential
 
     # dl.write_goja_output(events_true+phantom_scatt+detector_scatt+accidential)
-    histograms = np.loadtxt("histogram.txt")
+    histograms = load_model("histogram.txt")
     lors, lors_from_annihilation, lors_with_prompt, lors_true_anni= dl.find_lors(events, histograms)
     # lors_pairs = cf.remove_farthest_lor(lors)
     # tpr, spc, ppv, fpr = cf.binary_classification_probability(lors_pairs, use_prompt=False)
@@ -92,13 +101,15 @@ def main():
     plotter.plot_d_distribution(lors_true_anni, filename='d_distribution_true_annihilation_lors')
     plotter.plot_d_distribution(lors_with_prompt, filename='d_distribution_lors_with_prompt')
 
-    # d_tresholds = np.linspace(0, 437.3, 101)
-    # TPR, SPC, PPV, FPR = cf.binary_classification_simple(lors, d_tresholds)
-    # if len(TPR):
-        # plotter.plot_classification_plots(TPR, PPV, FPR, d_tresholds)
+    d_tresholds = np.linspace(0, 437.3, 101)
+    TPR, FPR, PPV, SPC = cf.binary_classification_simple(lors, d_tresholds)
+    if len(TPR):
+        plotter.plot_classification_plots(TPR, PPV, FPR, d_tresholds)
     print('[EXIT]')
 
 
 # execute main only if not imported to other script
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='Analysis of LORs from a single pair of files.')
+    event_cache.add_cache_argument(parser)
+    main(parser.parse_args().cache)
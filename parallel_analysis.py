@@ -0,0 +1,323 @@
+"""
+@author: Rafal Maselek
+This file contains functions for analysing many simulation files in parallel. Every worker process loads its files,
+finds LORs and classifies them, and sends back only small, mergeable results.
+"""
+import multiprocessing
+import numpy as np
+import data_loader as dl
+import classification as cf
+import instrumentation
+import probability_model
+from accumulators import Histogram, ConfusionCounts, LorFractions
+from event_cache import EventCache
+
+# bin edges of d distributions [mm]
+D_EDGES = np.linspace(0.0, 450.0, 91)
+# names of LOR groups with d distributions, like lists returned by find_lors
+LOR_GROUPS = ('all', 'annihilation', 'with_prompt', 'true_annihilation')
+
+
+class AnalysisResult:
+    """
+    Results of the analysis of a part of data: numbers of events of every coincidence type, fractions of LORs,
+    d distributions and classification counts.
+    """
+    def __init__(self, d_edges=D_EDGES):
+        self.n_events = dict((t.name, 0) for t in dl.CoincType)
+        self.fractions = LorFractions()
+        self.d_histograms = dict((group, Histogram(d_edges)) for group in LOR_GROUPS)
+        # one confusion matrix per decision rule registered in classification.DECISION_RULES
+        self.classification = dict((name, ConfusionCounts()) for name in cf.DECISION_RULES)
+        # instrumentation.Instrumentation object with metrics of the analysis, if instrumentation was enabled
+        self.metrics = None
+
+    def add(self, coinc_types, lors, classify=False):
+        """
+        Adds events to the result.
+        :param coinc_types: Array of coincidence types of events.
+        :param lors: LorBatch object with LORs of the same events.
+        :param classify: If true, LORs are classified (requires probabilities calculated from histograms).
+        :return: nothing
+        """
+        for t in dl.CoincType:
+            self.n_events[t.name] += int(np.count_nonzero(coinc_types == t.value))
+        self.fractions.add(*dl.count_sorted_lor_batch(lors))
+        self.fill_d_histograms(lors)
+        if classify:
+            count_classifications(lors, self.classification)
+
+    def fill_d_histograms(self, lors):
+        """
+        Adds d of LORs to the d distributions of all LOR_GROUPS.
+        :param lors: LorBatch object.
+        :return: nothing
+        """
+        with instrumentation.stage('histogramming', lors.d.size):
+            self.d_histograms['all'].fill(lors.d)
+            self.d_histograms['annihilation'].fill(lors.d[:, 0])
+            self.d_histograms['with_prompt'].fill(lors.d[:, 1:])
+            self.d_histograms['true_annihilation'].fill(lors.d[:, 0][lors.is_from_annihilation[:, 0]])
+
+    def merge(self, other):
+        """
+        Adds another result to this one.
+        :param other: AnalysisResult object.
+        :return: self
+        """
+        for name in self.n_events:
+            self.n_events[name] += other.n_events[name]
+        self.fractions.merge(other.fractions)
+        for group in LOR_GROUPS:
+            self.d_histograms[group].merge(other.d_histograms[group])
+        for name, counts in other.classification.items():
+            self.classification.setdefault(name, ConfusionCounts()).merge(counts)
+        if other.metrics is not None:
+            if self.metrics is None:
+                self.metrics = instrumentation.Instrumentation()
+            self.metrics.merge(other.metrics)
+        return self
+
+
+def _run_pool(tasks, worker, n_processes):
+    """
+    Executes worker for every task, in a process pool unless n_processes is 1.
+    :param tasks: List of arguments of worker.
+    :param worker: Top-level function executed for every task.
+    :param n_processes: Number of worker processes, 1 means that everything is done in the current process.
+    :return: List of results, in the same order as tasks.
+    """
+    if n_processes == 1:
+        return [worker(task) for task in tasks]
+    # rules registered in this process are given to workers also when they are not forked from it
+    pool = multiprocessing.Pool(n_processes, initializer=cf.use_rules, initargs=(cf.DECISION_RULES,))
+    try:
+        # every task is a whole file, so they are sent one by one to keep all workers busy
+        results = pool.map(worker, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    print('[{} FILE PAIRS ANALYSED IN {} PROCESSES]'.format(len(tasks), n_processes))
+    return results
+
+
+def count_classifications(lors, counts):
+    """
+    Classifies LORs with all decision rules of classification.DECISION_RULES and adds the results to confusion counts.
+    :param lors: LorBatch object with probabilities calculated from histograms.
+    :param counts: Dictionary mapping names of rules to ConfusionCounts objects, missing ones are added.
+    :return: nothing
+    """
+    pairs = cf.remove_farthest_lor_batch(lors)
+    for name, rule_counts in cf.evaluate_classifiers(pairs).items():
+        counts.setdefault(name, ConfusionCounts()).add(*rule_counts)
+
+
+def analyse_stream(files_511, files_prompt, edep_cut=0.06, use_goja_event_analysis=False, histograms=[],
+                   d_edges=D_EDGES, chunk_events=dl.DEFAULT_CHUNK_EVENTS, cache=None):
+    """
+    Analyses data chunk by chunk: events of a chunk are turned into LOR arrays, which are added to the accumulators of
+    the result and released before the next chunk is read, so memory does not grow with the number of files.
+    :param files_511: List of files of 511 keV data.
+    :param files_prompt: List of files of prompt data.
+    :param edep_cut: Lower selection value for deposited energy.
+    :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
+    :param histograms: ProbabilityModel object or edep histograms used to calculate LOR probabilities; classification
+    is skipped if empty.
+    :param d_edges: Bin edges of d distributions.
+    :param chunk_events: Maximal number of events in a chunk.
+    :param cache: Optional event_cache.EventCache object.
+    :return: AnalysisResult object.
+    """
+    model = probability_model.as_model(histograms)
+    result = AnalysisResult(d_edges)
+    for hits_511, hits_prompt in dl.iter_event_tables(files_511, files_prompt, edep_cut, use_goja_event_analysis,
+                                                      chunk_events, cache=cache, columns=dl.LOR_BRANCHES):
+        positions, edeps, coinc_types = dl.table_event_arrays(hits_511, hits_prompt)
+        lors = dl.lor_batch_from_arrays(positions, edeps, coinc_types, model)
+        result.add(coinc_types, lors, classify=model is not None)
+    print('[NO OF EVENTS: {}]'.format(sum(result.n_events.values())))
+    return result
+
+
+def analyse_store(store, histograms=[], d_edges=D_EDGES, chunk_events=dl.DEFAULT_CHUNK_EVENTS):
+    """
+    Same as analyse_stream, but events are read from an event store instead of simulation files.
+    :param store: event_store.EventStore object.
+    :param histograms: ProbabilityModel object or edep histograms used to calculate LOR probabilities; classification
+    is skipped if empty.
+    :param d_edges: Bin edges of d distributions.
+    :param chunk_events: Maximal number of events in a chunk.
+    :return: AnalysisResult object.
+    """
+    model = probability_model.as_model(histograms)
+    result = AnalysisResult(d_edges)
+    for start in range(0, len(store), chunk_events):
+        lors, coinc_types = store.lor_batch(model, start, start+chunk_events)
+        result.add(coinc_types, lors, classify=model is not None)
+    print('[NO OF EVENTS: {}]'.format(sum(result.n_events.values())))
+    return result
+
+
+def analyse_file_pair(task):
+    """
+    Loads data, finds LORs and classifies them. It is executed by worker processes.
+    :param task: Tuple: 511 keV file name(s), prompt file name(s), edep_cut, use_goja_event_analysis, histograms,
+    d_edges, cache directory (or None), True to collect metrics.
+    :return: AnalysisResult object.
+    """
+    files_511, files_prompt, edep_cut, use_goja_event_analysis, histograms, d_edges, cache_dir, instrumented = task
+    if isinstance(files_511, str):
+        files_511 = [files_511]
+    if isinstance(files_prompt, str):
+        files_prompt = [files_prompt]
+    cache = None if cache_dir is None else EventCache(cache_dir)
+    # metrics of every task are collected separately and sent back with its result
+    previous = instrumentation.use(instrumentation.Instrumentation(enabled=instrumented))
+    try:
+        result = analyse_stream(files_511, files_prompt, edep_cut, use_goja_event_analysis, histograms, d_edges,
+                                cache=cache)
+        if instrumented:
+            result.metrics = instrumentation.current()
+    finally:
+        instrumentation.use(previous)
+    return result
+
+
+def analyse_files(file_pairs, edep_cut=0.06, use_goja_event_analysis=False, histograms=[], n_processes=1,
+                  d_edges=D_EDGES, cache_dir=None):
+    """
+    Analyses pairs of files with 511 keV and prompt data, every pair in a separate task of a process pool.
+    :param file_pairs: List of tuples (511 keV file name(s), prompt file name(s)).
+    :param edep_cut: Lower selection value for deposited energy.
+    :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
+    :param histograms: ProbabilityModel object or edep histograms used to calculate LOR probabilities; classification
+    is skipped if empty.
+    :param n_processes: Number of worker processes, 1 means that everything is done in the current process.
+    :param d_edges: Bin edges of d distributions.
+    :param cache_dir: Directory of event_cache.EventCache with selected hits, None to disable caching.
+    :return: List of AnalysisResult objects, one for each pair of files, in the same order as file_pairs.
+    """
+    # tables of probabilities are built once and sent to all tasks
+    model = probability_model.as_model(histograms)
+    tasks = [(files_511, files_prompt, edep_cut, use_goja_event_analysis, model, d_edges, cache_dir,
+              instrumentation.enabled())
+             for files_511, files_prompt in file_pairs]
+    results = _run_pool(tasks, analyse_file_pair, n_processes)
+    for result in results:
+        if result.metrics is not None:
+            instrumentation.current().merge(result.metrics)
+    return results
+
+
+def check_edep_cuts(edep_cuts):
+    """
+    Raises ValueError if there are no cuts to sweep.
+    :param edep_cuts: List of lower selection values for deposited energy.
+    :return: nothing
+    """
+    if len(edep_cuts) == 0:
+        raise ValueError("At least one value of edep_cut is required!")
+
+
+def sweep_edep_cuts(files_511, files_prompt, edep_cuts, use_goja_event_analysis=False, histograms=[],
+                    d_edges=D_EDGES, chunk_size=dl.DEFAULT_CHUNK_SIZE):
+    """
+    Analyses data for many values of edep_cut with a single load. Hits passing the loosest cut are read once, then for
+    every cut proper hits are found with a mask on their edep, coincidences are selected and paired with prompt hits
+    again and LORs are analysed. Results are the same as those of analyse_stream run separately for every cut.
+    :param files_511: List of files of 511 keV data.
+    :param files_prompt: List of files of prompt data.
+    :param edep_cuts: List of lower selection values for deposited energy.
+    :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
+    :param histograms: ProbabilityModel object or edep histograms used to calculate LOR probabilities; classification
+    is skipped if empty.
+    :param d_edges: Bin edges of d distributions.
+    :param chunk_size: Number of tree entries read from a file in one bulk call.
+    :return: List of AnalysisResult objects, in the order of edep_cuts.
+    """
+    check_edep_cuts(edep_cuts)
+    model = probability_model.as_model(histograms)
+    loosest_cut = min(edep_cuts)
+    categories = dict((column, dl.StringCategories()) for column in dl.STRING_BRANCHES)
+    columns = dl.selected_branches(dl.LOR_BRANCHES, dl.COINCIDENCE_BRANCHES)
+    # hits of different files are kept apart, so that events of neighbouring files are never joined
+    hits_511 = [dl.select_file_hits(file_name, loosest_cut, use_goja_event_analysis, chunk_size, categories, columns,
+                                    drop_last_event=True)
+                for file_name in files_511]
+    hits_prompt = dl.HitTable.concatenate([dl.select_file_hits(file_name, loosest_cut, use_goja_event_analysis,
+                                                               chunk_size, categories, columns)
+                                           for file_name in files_prompt])
+    results = []
+    for edep_cut in edep_cuts:
+        pairs = dl.HitTable.concatenate([dl.select_coincidences(hits[hits.edep.astype(np.float64) >= edep_cut],
+                                                                edep_cut, use_goja_event_analysis, preselected=True)
+                                         for hits in hits_511])
+        prompts = hits_prompt[hits_prompt.edep.astype(np.float64) >= edep_cut]
+        n_events = min(len(pairs)//2, len(prompts))
+        positions, edeps, coinc_types = dl.table_event_arrays(pairs[:2*n_events], prompts[:n_events])
+        result = AnalysisResult(d_edges)
+        result.add(coinc_types, dl.lor_batch_from_arrays(positions, edeps, coinc_types, model),
+                   classify=model is not None)
+        print('[EDEP CUT {}: NO OF EVENTS: {}]'.format(edep_cut, n_events))
+        results.append(result)
+    return results
+
+
+def sweep_file_pair(task):
+    """
+    Runs sweep_edep_cuts for one pair of files. It is executed by worker processes.
+    :param task: Tuple: 511 keV file name(s), prompt file name(s), edep_cuts, use_goja_event_analysis, histograms,
+    d_edges, True to collect metrics.
+    :return: List of AnalysisResult objects, in the order of edep_cuts.
+    """
+    files_511, files_prompt, edep_cuts, use_goja_event_analysis, histograms, d_edges, instrumented = task
+    if isinstance(files_511, str):
+        files_511 = [files_511]
+    if isinstance(files_prompt, str):
+        files_prompt = [files_prompt]
+    previous = instrumentation.use(instrumentation.Instrumentation(enabled=instrumented))
+    try:
+        results = sweep_edep_cuts(files_511, files_prompt, edep_cuts, use_goja_event_analysis, histograms, d_edges)
+        if instrumented and len(results) > 0:
+            # metrics are attached to the first result only, so that they are not merged many times
+            results[0].metrics = instrumentation.current()
+    finally:
+        instrumentation.use(previous)
+    return results
+
+
+def sweep_files(file_pairs, edep_cuts, use_goja_event_analysis=False, histograms=[], n_processes=1,
+                d_edges=D_EDGES):
+    """
+    Same as analyse_files, but every pair of files is analysed for many values of edep_cut with sweep_edep_cuts.
+    :param file_pairs: List of tuples (511 keV file name(s), prompt file name(s)).
+    :param edep_cuts: List of lower selection values for deposited energy.
+    :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
+    :param histograms: ProbabilityModel object or edep histograms used to calculate LOR probabilities; classification
+    is skipped if empty.
+    :param n_processes: Number of worker processes, 1 means that everything is done in the current process.
+    :param d_edges: Bin edges of d distributions.
+    :return: List of lists of AnalysisResult objects: one list for each pair of files, one result for each cut.
+    """
+    check_edep_cuts(edep_cuts)
+    model = probability_model.as_model(histograms)
+    tasks = [(files_511, files_prompt, edep_cuts, use_goja_event_analysis, model, d_edges, instrumentation.enabled())
+             for files_511, files_prompt in file_pairs]
+    results = _run_pool(tasks, sweep_file_pair, n_processes)
+    for cut_results in results:
+        if len(cut_results) > 0 and cut_results[0].metrics is not None:
+            instrumentation.current().merge(cut_results[0].metrics)
+    return results
+
+
+def merge_results(results):
+    """
+    Merges results of many tasks.
+    :param results: List of AnalysisResult objects.
+    :return: AnalysisResult object.
+    """
+    merged = AnalysisResult(results[0].d_histograms['all'].edges if len(results) > 0 else D_EDGES)
+    for result in results:
+        merged.merge(result)
+    return merged
@@ -32,6 +32,24 @@ def plot_d_distribution(lors, filename):
     print('[D DISTRIBUTION PLOTTED]')
 
 
+def plot_d_histogram(edges, counts, filename):
+    """
+    Plots a distribution of LOR parameter d filled in advance, e.g. merged from many processes.
+    :param edges: Bin edges [mm].
+    :param counts: Numbers of LORs in bins.
+    :param filename: Name of the file with the plot.
+    :return: nothing
+    """
+    plt.clf()
+    fig, ax = plt.subplots()
+    ax.hist(edges[:-1], edges, weights=counts)
+    ax.set_title('distribution of distance from origin to line')
+    ax.set_xlabel('d [mm]')
+    ax.set_ylabel('entries [1]')
+    plt.savefig("results/"+filename)
+    print('[D DISTRIBUTION PLOTTED]')
+
+
 def plot_classification_plots(TPR, PPV, FPR, d_tresholds, filename='classification_plots.png'):
     """
     Plots classification plots, one contains TPR and PPV as a function of d_treshold, the second one contains ROC curve.
@@ -0,0 +1,156 @@
+"""
+@author: Rafal Maselek
+This file contains the probability model used to score LORs: 2D tables of probabilities that both hits of a LOR come
+from 511 keV gammas (p511) and that one comes from a 511 keV gamma and the other one from a prompt gamma
+(p_prompt_and_511), indexed by edep bins of both hits. Tables are precomputed from edep histograms and stored in
+a binary .npz file with a checksum.
+Usage:
+    python probability_model.py histogram.txt histogram.npz
+"""
+import hashlib
+import sys
+import numpy as np
+
+# rows of histogram.txt: lower edges of bins and histograms in the order of edep_probability.EDEP_LABELS
+HISTOGRAM_ROW_511 = 1
+HISTOGRAM_ROW_PROMPT = 4
+# version of the binary format
+MODEL_VERSION = 1
+
+
+def edep_bins(edges, edeps):
+    """
+    Finds histogram bins for an array of deposited energies with a binary search.
+    :param edges: Lower edges of equal-width bins (the first row of histogram.txt). Value edep belongs to bin ii if
+    edges[ii] < edep <= edges[ii+1].
+    :param edeps: Array of deposited energies.
+    :return: Array of bin indices; -1 for values outside of the histogram (edep <= edges[0] or above the upper edge
+    of the last bin).
+    """
+    edges = np.asarray(edges, dtype=np.float64)
+    edeps = np.asarray(edeps, dtype=np.float64)
+    upper_edge = edges[-1] + (edges[1]-edges[0])
+    bins = np.searchsorted(edges, edeps, side='left') - 1
+    bins[edeps > upper_edge] = -1
+    return bins
+
+
+class ProbabilityModel:
+    """
+    Precomputed tables of LOR probabilities. Tables have one more row and column than there are bins, filled with
+    zeros, which are picked by bin index -1 of hits outside of the histogram range.
+    """
+    def __init__(self, edges, p511, p_prompt_and_511):
+        """
+        :param edges: Lower edges of edep bins.
+        :param p511: Table of shape (n_bins+1, n_bins+1), probability that both hits come from 511 keV gammas.
+        :param p_prompt_and_511: Table of the same shape, probability that one hit comes from a 511 keV gamma and
+        the other one from a prompt gamma.
+        """
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.p511 = np.asarray(p511, dtype=np.float64)
+        self.p_prompt_and_511 = np.asarray(p_prompt_and_511, dtype=np.float64)
+
+    @classmethod
+    def from_histograms(cls, histograms):
+        """
+        Builds tables from edep histograms.
+        :param histograms: Array with lower edges of bins in the first row and histograms in the next ones (the content
+        of histogram.txt).
+        :return: ProbabilityModel object.
+        """
+        histograms = np.asarray(histograms, dtype=np.float64)
+        # the extra zero at the end is picked by bin index -1
+        p_511 = np.append(histograms[HISTOGRAM_ROW_511], 0.0)
+        p_prompt = np.append(histograms[HISTOGRAM_ROW_PROMPT], 0.0)
+        p511 = p_511[:, np.newaxis] * p_511[np.newaxis, :]
+        # (p1(prompt)*p2(511) + p1(511)*p2(prompt))
+        p_prompt_and_511 = p_prompt[:, np.newaxis] * p_511[np.newaxis, :] \
+            + p_511[:, np.newaxis] * p_prompt[np.newaxis, :]
+        return cls(histograms[0], p511, p_prompt_and_511)
+
+    def checksum(self):
+        """
+        :return: SHA-1 hex digest of the edges and tables.
+        """
+        sha = hashlib.sha1()
+        for array in (self.edges, self.p511, self.p_prompt_and_511):
+            sha.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+        return sha.hexdigest()
+
+    def save(self, file_name):
+        """
+        Saves the model to a binary .npz file.
+        :param file_name: Name of the output file.
+        :return: nothing
+        """
+        with open(file_name, 'wb') as f:
+            np.savez(f, edges=self.edges, p511=self.p511, p_prompt_and_511=self.p_prompt_and_511,
+                     checksum=np.array(self.checksum()), version=np.array(MODEL_VERSION))
+
+    @classmethod
+    def load(cls, file_name):
+        """
+        Loads a model saved with ProbabilityModel.save and verifies its checksum.
+        :param file_name: Name of the input file.
+        :return: ProbabilityModel object.
+        """
+        with np.load(file_name) as arrays:
+            if int(arrays['version']) != MODEL_VERSION:
+                raise Exception("Unsupported version of the probability model in "+file_name+"!")
+            model = cls(arrays['edges'], arrays['p511'], arrays['p_prompt_and_511'])
+            checksum = str(arrays['checksum'])
+        if model.checksum() != checksum:
+            raise Exception("Wrong checksum of the probability model in "+file_name+"!")
+        return model
+
+    def bins(self, edeps):
+        """
+        :return: Array of edep bin indices, -1 for values outside of the histogram.
+        """
+        return edep_bins(self.edges, edeps)
+
+    def probabilities(self, edep1, edep2):
+        """
+        Calculates probabilities for LORs connecting hits with given deposited energies. LORs with a hit outside of the
+        histogram range get zero probabilities.
+        :param edep1: Array of deposited energies of the first hit.
+        :param edep2: Array of deposited energies of the second hit.
+        :return: Arrays of probabilities that both photons are 511 keV and that one is 511 keV and the other is prompt.
+        """
+        bin1 = self.bins(edep1)
+        bin2 = self.bins(edep2)
+        return self.p511[bin1, bin2], self.p_prompt_and_511[bin1, bin2]
+
+
+def as_model(histograms):
+    """
+    Converts edep histograms into a probability model.
+    :param histograms: ProbabilityModel object, array of edep histograms (the content of histogram.txt), or an empty
+    list/None.
+    :return: ProbabilityModel object or None if there are no histograms.
+    """
+    if histograms is None or isinstance(histograms, ProbabilityModel):
+        return histograms
+    if len(histograms) == 0:
+        return None
+    return ProbabilityModel.from_histograms(histograms)
+
+
+def load_model(file_name):
+    """
+    Loads a probability model from a binary .npz file or builds it from a text file with edep histograms.
+    :param file_name: Name of the file, e.g. histogram.npz or histogram.txt.
+    :return: ProbabilityModel object.
+    """
+    if file_name.endswith('.npz'):
+        return ProbabilityModel.load(file_name)
+    return ProbabilityModel.from_histograms(np.loadtxt(file_name))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python probability_model.py HISTOGRAM.txt MODEL.npz")
+        sys.exit(1)
+    load_model(sys.argv[1]).save(sys.argv[2])
+    print("[PROBABILITY MODEL SAVED TO "+sys.argv[2]+"]")
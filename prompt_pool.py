@@ -0,0 +1,140 @@
+"""
+@author: Rafal Maselek
+This file contains a pool of prompt hits used for event mixing. Prompt files are selected once, and the pool is kept in
+memory (or saved to a binary file), so that many mixing trials can be done over the same 511 keV data without reading
+prompt files again.
+"""
+import numpy as np
+import data_loader as dl
+
+# ways of drawing prompt hits: in file order (as load_data does), random permutation, random with replacement
+MIXING_MODES = ('order', 'permutation', 'random')
+
+
+class PromptPool:
+    """
+    Selected prompt hits which can be drawn by index. The i-th coincidence of 511 keV hits is paired with the prompt
+    hit with the i-th drawn index.
+    """
+    def __init__(self, hits):
+        """
+        :param hits: HitTable of selected prompt hits.
+        """
+        self.hits = hits
+
+    @classmethod
+    def from_files(cls, file_list_prompt, edep_cut=0.06, use_goja_event_analysis=False,
+                   chunk_size=dl.DEFAULT_CHUNK_SIZE, cache=None):
+        """
+        Selects prompt hits from all the files.
+        :param file_list_prompt: List of files of prompt data.
+        :param edep_cut: Lower selection value for deposited energy.
+        :param use_goja_event_analysis: If true, GOJA-like analysis is performed.
+        :param chunk_size: Number of tree entries read from a file in one bulk call.
+        :param cache: Optional event_cache.EventCache object.
+        :return: PromptPool object.
+        """
+        print('\n[LOADING PROMPT POOL...]')
+        hits = dl.HitTable.concatenate(list(dl.iter_selections(file_list_prompt, 'prompt', edep_cut,
+                                                               use_goja_event_analysis, chunk_size, cache=cache)))
+        print('[NO OF PROMPT HITS IN POOL: {}]'.format(len(hits)))
+        return cls(hits)
+
+    def save(self, file_name):
+        """
+        Saves the pool to a binary .npz file.
+        :param file_name: Name of the output file.
+        :return: nothing
+        """
+        self.hits.save(file_name)
+
+    @classmethod
+    def load(cls, file_name):
+        """
+        Loads a pool saved with PromptPool.save.
+        :param file_name: Name of the input file.
+        :return: PromptPool object.
+        """
+        return cls(dl.HitTable.load(file_name))
+
+    def __len__(self):
+        return len(self.hits)
+
+    def draw(self, indices):
+        """
+        :param indices: Array of indices of prompt hits.
+        :return: HitTable of prompt hits with given indices.
+        """
+        return self.hits[np.asarray(indices, dtype=np.int64)]
+
+    def indices(self, n_events, mode='order', seed=None):
+        """
+        Draws indices of prompt hits for a number of events.
+        :param n_events: Number of events.
+        :param mode: 'order' - the first n_events hits in file order, 'permutation' - n_events hits of a random
+        permutation of the pool, 'random' - hits drawn with replacement.
+        :param seed: Seed of the random number generator, used by 'permutation' and 'random' modes.
+        :return: Array of indices.
+        """
+        return self._indices(n_events, mode, np.random.RandomState(seed))
+
+    def mixing_indices(self, n_events, n_realizations, mode='permutation', seed=None):
+        """
+        Draws indices for many independent mixing realizations.
+        :param n_events: Number of events in every realization.
+        :param n_realizations: Number of realizations.
+        :param mode: 'permutation' or 'random', see PromptPool.indices.
+        :param seed: Seed of the random number generator used for all realizations.
+        :return: Array of indices of shape (n_realizations, n_events).
+        """
+        if mode == 'order':
+            raise Exception("Mode 'order' gives the same prompt hits in every realization!")
+        rng = np.random.RandomState(seed)
+        indices = np.empty((n_realizations, n_events), dtype=np.int64)
+        for ii in range(n_realizations):
+            indices[ii] = self._indices(n_events, mode, rng)
+        return indices
+
+    def mix(self, hits_511, mode='order', seed=None):
+        """
+        Pairs coincidences of 511 keV hits with prompt hits from the pool. For 'order' and 'permutation' modes both
+        tables are truncated to the same number of events, like in dl.load_event_tables.
+        :param hits_511: HitTable of pairs of annihilation hits.
+        :param mode: Mode of drawing prompt hits, see PromptPool.indices.
+        :param seed: Seed of the random number generator.
+        :return: Two HitTables: pairs of annihilation hits and prompt hits of the same events.
+        """
+        n_events = self._n_events(hits_511, mode)
+        return hits_511[:2*n_events], self.draw(self.indices(n_events, mode, seed))
+
+    def iter_mixings(self, hits_511, n_realizations, mode='permutation', seed=None):
+        """
+        Pairs the same coincidences of 511 keV hits with prompt hits many times.
+        :param hits_511: HitTable of pairs of annihilation hits.
+        :param n_realizations: Number of realizations.
+        :param mode: 'permutation' or 'random', see PromptPool.indices.
+        :param seed: Seed of the random number generator used for all realizations.
+        :return: Generator of tuples of two HitTables: pairs of annihilation hits and prompt hits of the same events.
+        """
+        n_events = self._n_events(hits_511, mode)
+        hits_511 = hits_511[:2*n_events]
+        for indices in self.mixing_indices(n_events, n_realizations, mode, seed):
+            yield hits_511, self.draw(indices)
+
+    def _n_events(self, hits_511, mode):
+        if mode == 'random':
+            return len(hits_511)//2
+        return min(len(hits_511)//2, len(self))
+
+    def _indices(self, n_events, mode, rng):
+        if mode not in MIXING_MODES:
+            raise Exception('Unknown mixing mode: {}!'.format(mode))
+        if mode == 'random':
+            if len(self) == 0 and n_events > 0:
+                raise Exception('Prompt pool is empty!')
+            return rng.randint(0, max(len(self), 1), size=n_events).astype(np.int64)
+        if n_events > len(self):
+            raise Exception('Not enough prompt hits in the pool: {} needed, {} available!'.format(n_events, len(self)))
+        if mode == 'order':
+            return np.arange(n_events, dtype=np.int64)
+        return rng.permutation(len(self))[:n_events].astype(np.int64)
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+@author: Rafal Maselek
+This file contains the run scheduler. A study is described by a JSON config file and done in a single pass over the
+data: every pair of files is loaded once, chunk by chunk, and every chunk is given to all analyses listed in the
+config. Pairs of files are analysed by separate tasks of a process pool.
+Usage:
+    python scheduler.py study.json
+"""
+import json
+import multiprocessing
+import os
+import sys
+import numpy as np
+import classification as cf
+import data_loader as dl
+import edep_probability
+import instrumentation
+import parallel_analysis as pa
+import plotter
+import probability_model
+from accumulators import ConfusionCounts, LorFractions, HistogramSet
+from event_cache import EventCache
+
+# values used for keys missing in the config file
+DEFAULT_CONFIG = {
+    # files are named folder/name{number}{file_suffix}, numbers from range(first_file, last_file+1, file_step)
+    'folder_511': "data/NEMA",
+    'folder_prompt': "data/NEMA",
+    'name_511': "anni",
+    'name_prompt': "prompt",
+    # ".npz" for synthetic data (see synthetic_data.py)
+    'file_suffix': ".root",
+    'first_file': 1,
+    'last_file': 100,
+    'file_step': 1,
+    'edep_cut': 0.06,
+    'goja_event_analysis': False,
+    # file with edep histograms or a probability model, required by the classification
+    'histograms': None,
+    'analyses': ['d_distributions', 'fractions', 'classification', 'edep_histograms', 'goja_export'],
+    # None means one process per CPU
+    'n_processes': None,
+    # directory with cached selections of hits (e.g. "cache"), None to disable caching
+    'cache_dir': None,
+    # file with times of stages and numbers of rejected hits, None to disable instrumentation
+    'metrics_file': None,
+    # options of edep histograms: experiment-derived smearing and the name of the output files without extension
+    'smear': False,
+    'seed': None,
+    'edep_histogram_file': "results/histogram",
+}
+
+
+class Chunk:
+    """
+    Chunk of events given to all analyses. LORs are found once, when they are used for the first time.
+    """
+    def __init__(self, hits_511, hits_prompt, model, index):
+        self.hits_511 = hits_511
+        self.hits_prompt = hits_prompt
+        self.model = model
+        # number of the chunk in its pair of files
+        self.index = index
+        self._lors = None
+
+    @property
+    def lors(self):
+        if self._lors is None:
+            positions, edeps, coinc_types = dl.table_event_arrays(self.hits_511, self.hits_prompt)
+            self._lors = dl.lor_batch_from_arrays(positions, edeps, coinc_types, self.model)
+        return self._lors
+
+
+class DDistributions:
+    """
+    Distributions of LOR parameter d in groups of LOR_GROUPS.
+    """
+    name = 'd_distributions'
+    columns = dl.LOR_BRANCHES
+    uses_model = False
+
+    def __init__(self, config, file_pair=None):
+        # only d distributions of the result are filled
+        self.result = pa.AnalysisResult()
+
+    def add(self, chunk):
+        self.result.fill_d_histograms(chunk.lors)
+
+    def merge(self, other):
+        self.result.merge(other.result)
+        return self
+
+    def finish(self, per_file, file_numbers, config):
+        for group in pa.LOR_GROUPS:
+            histogram = self.result.d_histograms[group]
+            np.savetxt("results/d_distribution_"+group+".txt",
+                       np.column_stack([histogram.edges[:-1], histogram.counts]))
+            plotter.plot_d_histogram(histogram.edges, histogram.counts, "d_distribution_"+group+".png")
+
+
+class Fractions:
+    """
+    Numbers of true LORs that are the closest to the origin, the middle or the farthest ones in their events.
+    """
+    name = 'fractions'
+    columns = dl.LOR_BRANCHES
+    uses_model = False
+
+    def __init__(self, config, file_pair=None):
+        self.fractions = LorFractions()
+
+    def add(self, chunk):
+        self.fractions.add(*dl.count_sorted_lor_batch(chunk.lors))
+
+    def merge(self, other):
+        self.fractions.merge(other.fractions)
+        return self
+
+    def finish(self, per_file, file_numbers, config):
+        print("[FRACTIONS OF LORS: D_MIN={} D_MID={} D_MAX={}]".format(*self.fractions.fractions()))
+        if len(per_file) > 1:
+            d_min, d_mid, d_max = zip(*[analysis.fractions.fractions() for analysis in per_file])
+            plotter.plot_lors_fractions(d_min, d_mid, d_max, file_numbers, filename="fractions_of_lors.png")
+
+
+class Classification:
+    """
+    Confusion counts of all decision rules registered in classification.DECISION_RULES.
+    """
+    name = 'classification'
+    columns = dl.LOR_BRANCHES
+    uses_model = True
+
+    def __init__(self, config, file_pair=None):
+        self.counts = dict((name, ConfusionCounts()) for name in cf.DECISION_RULES)
+
+    def add(self, chunk):
+        pa.count_classifications(chunk.lors, self.counts)
+
+    def merge(self, other):
+        for name, counts in other.counts.items():
+            self.counts.setdefault(name, ConfusionCounts()).merge(counts)
+        return self
+
+    def finish(self, per_file, file_numbers, config):
+        for name in self.counts:
+            print("[CLASSIFICATION {}: TPR={} SPC={} PPV={} FPR={}]".format(name.upper(),
+                                                                           *self.counts[name].coefficients()))
+            if len(per_file) > 1:
+                TPR, SPC, PPV, FPR = zip(*[analysis.counts[name].coefficients() for analysis in per_file])
+                plotter.plot_classification_plots(TPR, PPV, FPR, file_numbers, "lors_class_"+name+".png")
+
+
+class EdepHistograms:
+    """
+    Edep histograms of edep_probability.EDEP_LABELS categories, saved as text and as a probability model.
+    """
+    name = 'edep_histograms'
+    columns = edep_probability.EDEP_BRANCHES
+    uses_model = False
+
+    def __init__(self, config, file_pair=None):
+        self.smear = config['smear']
+        self.seed = config['seed']
+        self.file_number = None if file_pair is None else file_pair[0]
+        self.histograms = HistogramSet(np.linspace(edep_probability.EDEP_RANGE[0], edep_probability.EDEP_RANGE[1],
+                                                   edep_probability.EDEP_BIN_NO+1),
+                                       len(edep_probability.EDEP_LABELS))
+
+    def add(self, chunk):
+        edep = edep_probability.edep_categories(chunk.hits_511, chunk.hits_prompt)
+        if self.smear:
+            # every chunk of every file uses a different seed derived from the seed of the study
+            seed = None if self.seed is None else [self.seed, self.file_number, chunk.index]
+            edep = edep_probability.smear_edeps(edep, seed)
+        for ii, arr in enumerate(edep):
+            self.histograms.fill(ii, arr)
+
+    def merge(self, other):
+        self.histograms.merge(other.histograms)
+        return self
+
+    def finish(self, per_file, file_numbers, config):
+        distr = self.histograms.normalized()
+        print("[EDEP HISTOGRAMS: {} ENTRIES]".format(self.histograms.n_entries))
+        edep_probability.plot_edep_histograms(distr, self.histograms.edges, "_all")
+        file_name = config['edep_histogram_file']
+        edep_probability.save_hist(self.histograms.edges, distr, file_name+".txt")
+        probability_model.load_model(file_name+".txt").save(file_name+".npz")
+
+
+class GojaExport:
+    """
+    GOJA-like output of coincidences, one text file per file with 511 keV data, written chunk by chunk.
+    """
+    name = 'goja_export'
+    columns = ['posX', 'posY', 'posZ', 'time', 'volumeID', 'edep', 'sourcePosX', 'sourcePosY', 'sourcePosZ']
+    uses_model = False
+
+    def __init__(self, config, file_pair=None):
+        self.file_names = []
+        if file_pair is not None:
+            self.file_names.append("results/goja_"+os.path.splitext(os.path.basename(file_pair[1]))[0]+".txt")
+
+    def add(self, chunk):
+        dl.write_goja_output(chunk.hits_511, self.file_names[0], append=chunk.index > 0)
+
+    def merge(self, other):
+        self.file_names.extend(other.file_names)
+        return self
+
+    def finish(self, per_file, file_numbers, config):
+        print("[GOJA OUTPUT WRITTEN TO {} FILES]".format(len(self.file_names)))
+
+
+# analyses available in config files, by name
+ANALYSES = {}
+
+
+def register_analysis(analysis_class):
+    """
+    Makes an analysis available in config files. An analysis class has attributes name, columns (branches it needs)
+    and uses_model (True if it needs LOR probabilities), a constructor taking the config and a tuple (file number,
+    511 keV file name, prompt file name) or None for merged results, and methods add(chunk), merge(other) and
+    finish(per_file, file_numbers, config).
+    :param analysis_class: Class of the analysis.
+    :return: analysis_class
+    """
+    ANALYSES[analysis_class.name] = analysis_class
+    return analysis_class
+
+
+for analysis_class in (DDistributions, Fractions, Classification, EdepHistograms, GojaExport):
+    register_analysis(analysis_class)
+
+
+def read_config(file_name):
+    """
+    Reads a config file, missing keys get values from DEFAULT_CONFIG.
+    :param file_name: Name of the JSON file.
+    :return: Dictionary with the config.
+    """
+    with open(file_name) as f:
+        config = json.load(f)
+    unknown = set(config) - set(DEFAULT_CONFIG)
+    if len(unknown) > 0:
+        raise Exception("Unknown keys in "+file_name+": "+", ".join(sorted(unknown)))
+    return dict(DEFAULT_CONFIG, **config)
+
+
+def file_numbers(config):
+    return list(range(config['first_file'], config['last_file']+1, config['file_step']))
+
+
+def analyse_file_pair(task):
+    """
+    Loads a pair of files once and gives every chunk of events to all analyses. It is executed by worker processes.
+    :param task: Tuple: file number, 511 keV file name, prompt file name, config, list of analysis classes,
+    probability model (or None), True to collect metrics.
+    :return: List of analyses (in the order of classes) and Instrumentation object (or None).
+    """
+    file_number, file_511, file_prompt, config, analysis_classes, model, instrumented = task
+    cache = None if config['cache_dir'] is None else EventCache(config['cache_dir'])
+    analyses = [analysis_class(config, (file_number, file_511, file_prompt)) for analysis_class in analysis_classes]
+    # only branches needed by at least one analysis are read
+    columns = []
+    for analysis_class in analysis_classes:
+        columns.extend(analysis_class.columns)
+    columns = dl.selected_branches(columns, [])
+    previous = instrumentation.use(instrumentation.Instrumentation(enabled=instrumented))
+    try:
+        for ii, (hits_511, hits_prompt) in enumerate(dl.iter_event_tables([file_511], [file_prompt],
+                                                                          config['edep_cut'],
+                                                                          config['goja_event_analysis'],
+                                                                          cache=cache, columns=columns)):
+            chunk = Chunk(hits_511, hits_prompt, model, ii)
+            for analysis in analyses:
+                analysis.add(chunk)
+        metrics = instrumentation.current() if instrumented else None
+    finally:
+        instrumentation.use(previous)
+    return analyses, metrics
+
+
+def run_study(config):
+    """
+    Runs all analyses of a study in a single pass over the data.
+    :param config: Dictionary with the config, see DEFAULT_CONFIG.
+    :return: Dictionary mapping names of analyses to merged analyses.
+    """
+    config = dict(DEFAULT_CONFIG, **config)
+    for name in config['analyses']:
+        if name not in ANALYSES:
+            raise Exception("Unknown analysis: "+name+"!")
+    analysis_classes = [ANALYSES[name] for name in config['analyses']]
+    model = None
+    if config['histograms'] is not None:
+        model = probability_model.load_model(config['histograms'])
+    elif any(analysis_class.uses_model for analysis_class in analysis_classes):
+        raise Exception("Histograms are required by the classification, set 'histograms' in the config!")
+    numbers = file_numbers(config)
+    tasks = [(nn, os.path.join(config['folder_511'], config['name_511']+str(nn)+config['file_suffix']),
+              os.path.join(config['folder_prompt'], config['name_prompt']+str(nn)+config['file_suffix']),
+              config, analysis_classes, model, instrumentation.enabled())
+             for nn in numbers]
+    n_processes = config['n_processes'] or multiprocessing.cpu_count()
+    results = pa._run_pool(tasks, analyse_file_pair, n_processes)
+    merged = {}
+    for ii, analysis_class in enumerate(analysis_classes):
+        per_file = [analyses[ii] for analyses, metrics in results]
+        total = analysis_class(config)
+        for analysis in per_file:
+            total.merge(analysis)
+        total.finish(per_file, numbers, config)
+        merged[analysis_class.name] = total
+    for analyses, metrics in results:
+        if metrics is not None:
+            instrumentation.current().merge(metrics)
+    return merged
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python scheduler.py STUDY.json")
+        sys.exit(1)
+    print('[START]')
+    config = read_config(sys.argv[1])
+    if config['metrics_file'] is not None:
+        instrumentation.enable()
+    run_study(config)
+    if config['metrics_file'] is not None:
+        instrumentation.current().report()
+        instrumentation.current().save(config['metrics_file'])
+    print('[EXIT]')
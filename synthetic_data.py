@@ -0,0 +1,302 @@
+"""
+@author: Rafal Maselek
+This file contains a generator of synthetic GATE-like Hits data: back-to-back 511 keV gammas or 1157 keV prompt gammas
+emitted from a source, optionally scattered in a phantom and registered by a cylindrical detector. Energies deposited
+in the detector follow the Klein-Nishina distribution. Everything is generated with array operations, so large data
+sets for tests and benchmarks can be produced without the simulation.
+Data can be saved as .npz files (read by data_loader.read_hits like ROOT files) or as ROOT files.
+Usage:
+    python synthetic_data.py DIRECTORY [--files N] [--events N] [--format npz|root] [--seed N]
+"""
+import argparse
+import os
+import time
+import numpy as np
+import data_loader as dl
+
+# energies of gammas [MeV]
+GAMMA_ENERGIES = {'511': 0.511, 'prompt': 1.157}
+ELECTRON_MASS = 0.511 # [MeV]
+SPEED_OF_LIGHT = 299.792458 # [mm/ns]
+# strings stored in GATE C-string branches (the last character is removed by dl.is_compton_process)
+PROCESS_NAMES = ['compt\x00', 'Rayl\x00', 'eIoni\x00']
+VOLUME_NAMES = ['NULL\x00', 'crystal\x00', 'phantom\x00']
+# maximal number of scatterings of a gamma in the detector
+MAX_CRYSTAL_SCATTERS = 5
+
+
+def isotropic_directions(rng, n):
+    """
+    :return: Array of n random unit vectors of shape (n, 3).
+    """
+    cos_theta = 2.0*rng.random(n)-1.0
+    sin_theta = np.sqrt(1.0-cos_theta**2)
+    u = rng.random(n)
+    cos_phi = np.cos(2.0*np.pi*u)
+    # sin(phi) is negative for phi > pi, it is calculated without the second trigonometric function
+    sin_phi = np.copysign(np.sqrt(1.0-cos_phi**2), 0.5-u)
+    directions = np.empty((n, 3))
+    directions[:, 0] = sin_theta*cos_phi
+    directions[:, 1] = sin_theta*sin_phi
+    directions[:, 2] = cos_theta
+    return directions
+
+
+def butcher_messel_cos(rng, k, ratio_min, weight_log, weight_square):
+    """
+    Single pass of klein_nishina_cos for all gammas.
+    :return: Array of sampled cosines and boolean array, true for accepted samples.
+    """
+    r = rng.random((3, len(k)))
+    ratio_min_square = ratio_min**2
+    ratio = np.where(r[0]*(weight_log+weight_square) < weight_log, np.exp(-weight_log*r[1]),
+                     np.sqrt(ratio_min_square+(1.0-ratio_min_square)*r[1]))
+    one_minus_cos = (1.0-ratio)/(k*ratio)
+    sin_square = one_minus_cos*(2.0-one_minus_cos)
+    return 1.0-one_minus_cos, r[2] <= 1.0-ratio*sin_square/(1.0+ratio**2)
+
+
+def klein_nishina_cos(rng, energies):
+    """
+    Samples cosines of Compton scattering angles from the Klein-Nishina distribution with the method of Butcher and
+    Messel (used by Geant4), done for all gammas at once. The ratio of energies after and before scattering is drawn
+    from a mixture of 1/x and x distributions and accepted with probability of at least 1/2, so few passes are needed.
+    :param rng: np.random.Generator object.
+    :param energies: Array of gamma energies [MeV].
+    :return: Array of cosines.
+    """
+    k = np.asarray(energies, dtype=np.float64)/ELECTRON_MASS
+    # minimal ratio of energies (backscattering) and weights of the two parts of the mixture
+    ratio_min = 1.0/(1.0+2.0*k)
+    weight_log = -np.log(ratio_min)
+    weight_square = 0.5*(1.0-ratio_min**2)
+    # the first pass covers all gammas, rejected samples are drawn again only for the remaining ones
+    cos_theta, accepted = butcher_messel_cos(rng, k, ratio_min, weight_log, weight_square)
+    todo = np.flatnonzero(~accepted)
+    while len(todo) > 0:
+        cos_todo, accepted = butcher_messel_cos(rng, k[todo], ratio_min[todo], weight_log[todo], weight_square[todo])
+        cos_theta[todo[accepted]] = cos_todo[accepted]
+        todo = todo[~accepted]
+    return cos_theta
+
+
+def scattered_energy(energies, cos_theta):
+    """
+    :return: Energies of gammas after Compton scattering [MeV].
+    """
+    return energies/(1.0+energies/ELECTRON_MASS*(1.0-cos_theta))
+
+
+def generate_hits(n_events, kind='511', seed=None, first_event_id=0, activity=1.0e6, source_position=(0.0, 0.0, 0.0),
+                  source_spread=1.0, radius=437.3, thickness=19.0, length=500.0, n_strips=192,
+                  detection_efficiency=0.6, mean_crystal_scatters=0.5, p_phantom_compton=0.3,
+                  p_phantom_rayleigh=0.02, p_crystal_rayleigh=0.01, electron_fraction=0.05, position_spread=20.0):
+    """
+    Generates hits of many events.
+    :param n_events: Number of decays.
+    :param kind: '511' for pairs of back-to-back annihilation gammas, 'prompt' for single 1157 keV gammas.
+    :param seed: Seed of the random number generator.
+    :param first_event_id: eventID of the first decay.
+    :param activity: Number of decays per second, used to generate decay times.
+    :param source_position: Mean position of decays [mm].
+    :param source_spread: Standard deviation of the position of decays [mm].
+    :param radius: Inner radius of the detector [mm].
+    :param thickness: Thickness of the detector layer [mm].
+    :param length: Length of the detector [mm].
+    :param n_strips: Number of strips, strip index is stored in volumeID[1].
+    :param detection_efficiency: Probability that a gamma reaching the detector interacts with it.
+    :param mean_crystal_scatters: Mean number of additional scatterings of a gamma in the detector (Poisson).
+    :param p_phantom_compton: Probability of Compton scattering of a gamma in the phantom.
+    :param p_phantom_rayleigh: Probability of Rayleigh scattering of a gamma in the phantom.
+    :param p_crystal_rayleigh: Probability that a hit comes after Rayleigh scattering in the detector.
+    :param electron_fraction: Fraction of hits registered as secondary electrons.
+    :param position_spread: Standard deviation of the distance between consecutive hits of a gamma [mm].
+    :return: HitTable with hits sorted by eventID.
+    """
+    if kind not in GAMMA_ENERGIES:
+        raise Exception("Unknown kind of data: {}!".format(kind))
+    rng = np.random.default_rng(seed)
+    n_gammas_per_event = 2 if kind == '511' else 1
+
+    # decays
+    decay_times = np.cumsum(rng.exponential(1.0/activity, n_events))
+    sources = np.asarray(source_position, dtype=np.float64) + rng.normal(0.0, source_spread, (n_events, 3))
+    directions = isotropic_directions(rng, n_events)
+    if n_gammas_per_event == 2:
+        directions = np.stack((directions, -directions), axis=1).reshape(-1, 3)
+
+    # gammas
+    n_gammas = n_events*n_gammas_per_event
+    event = np.repeat(np.arange(n_events), n_gammas_per_event)
+    photon_id = np.tile(np.arange(1, n_gammas_per_event+1), n_events)
+    origins = sources[event]
+    energies = np.full(n_gammas, GAMMA_ENERGIES[kind])
+    n_phantom_compton = (rng.random(n_gammas) < p_phantom_compton).astype(np.int32)
+    scattered = np.flatnonzero(n_phantom_compton)
+    energies[scattered] = scattered_energy(energies[scattered], klein_nishina_cos(rng, energies[scattered]))
+    directions[scattered] = isotropic_directions(rng, len(scattered))
+    n_phantom_rayleigh = (rng.random(n_gammas) < p_phantom_rayleigh).astype(np.int32)
+
+    # first interaction point inside the cylindrical layer
+    a = directions[:, 0]**2+directions[:, 1]**2
+    b = 2.0*(origins[:, 0]*directions[:, 0]+origins[:, 1]*directions[:, 1])
+    c = origins[:, 0]**2+origins[:, 1]**2-radius**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        path = (-b+np.sqrt(b**2-4.0*a*c))/(2.0*a) + rng.uniform(0.0, thickness, n_gammas)/np.sqrt(a)
+        first_positions = origins + path[:, np.newaxis]*directions
+        detected = (a > 0) & (c < 0) & (np.abs(first_positions[:, 2]) <= length/2.0) \
+            & (rng.random(n_gammas) < detection_efficiency)
+
+    # scatterings in the detector, only detected gammas are followed; hits of a gamma are stored next to each other
+    detected = np.flatnonzero(detected)
+    n_scatters = np.minimum(1+rng.poisson(mean_crystal_scatters, len(detected)), MAX_CRYSTAL_SCATTERS)
+    gamma = np.repeat(detected, n_scatters)
+    n_hits = len(gamma)
+    first_hit = np.cumsum(n_scatters)-n_scatters
+    step = np.arange(n_hits)-np.repeat(first_hit, n_scatters)
+    # deposited energies are calculated step by step for all gammas at once
+    edeps = np.empty(n_hits)
+    energies = energies[detected]
+    for ii in range(MAX_CRYSTAL_SCATTERS):
+        active = np.flatnonzero(n_scatters > ii)
+        if len(active) == 0:
+            break
+        energies_after = scattered_energy(energies[active], klein_nishina_cos(rng, energies[active]))
+        edeps[first_hit[active]+ii] = energies[active]-energies_after
+        energies[active] = energies_after
+
+    # hits
+    hit_event = event[gamma]
+    hit_photon_id = photon_id[gamma].astype(np.int32)
+    positions = first_positions[gamma]
+    # only later scatterings are displaced from the first interaction point
+    later = np.flatnonzero(step > 0)
+    positions[later] += rng.normal(0.0, position_spread, (len(later), 3))*step[later, np.newaxis]
+    times = decay_times[hit_event] + (path[gamma]+step*position_spread)/SPEED_OF_LIGHT*1e-9
+    is_electron = rng.random(n_hits) < electron_fraction
+    n_crystal_rayleigh = (rng.random(n_hits) < p_crystal_rayleigh).astype(np.int32)
+    strips = np.floor((np.arctan2(positions[:, 1], positions[:, 0])+np.pi)/(2.0*np.pi)*n_strips).astype(np.int32)
+    volume_id = np.full((n_hits, dl.VOLUME_ID_SIZE), -1, dtype=np.int32)
+    volume_id[:, 0] = 0
+    volume_id[:, 1] = strips % n_strips
+    rayleigh_volume = np.where(n_crystal_rayleigh > 0, VOLUME_NAMES.index('crystal\x00'),
+                               np.where(n_phantom_rayleigh[gamma] > 0, VOLUME_NAMES.index('phantom\x00'),
+                                        VOLUME_NAMES.index('NULL\x00')))
+    hit_sources = sources.astype(np.float32)[hit_event]
+
+    columns = {
+        'PDGEncoding': np.where(is_electron, 11, 22).astype(np.int32),
+        'trackID': np.where(is_electron, hit_photon_id+n_gammas_per_event, hit_photon_id).astype(np.int32),
+        'parentID': np.where(is_electron, hit_photon_id, 0).astype(np.int32),
+        'time': times,
+        'edep': edeps.astype(np.float32),
+        'posX': positions[:, 0].astype(np.float32),
+        'posY': positions[:, 1].astype(np.float32),
+        'posZ': positions[:, 2].astype(np.float32),
+        'baseID': np.zeros(n_hits, dtype=np.int32),
+        'photonID': hit_photon_id,
+        'nPhantomCompton': n_phantom_compton[gamma],
+        'nCrystalCompton': (step+1).astype(np.int32),
+        'nPhantomRayleigh': n_phantom_rayleigh[gamma],
+        'nCrystalRayleigh': n_crystal_rayleigh,
+        'primaryID': hit_photon_id,
+        'sourcePosX': hit_sources[:, 0],
+        'sourcePosY': hit_sources[:, 1],
+        'sourcePosZ': hit_sources[:, 2],
+        'sourceID': np.zeros(n_hits, dtype=np.int32),
+        'eventID': (hit_event+first_event_id).astype(np.int32),
+        'volumeID': volume_id,
+        'processName': np.where(is_electron, PROCESS_NAMES.index('eIoni\x00'),
+                                np.where(n_crystal_rayleigh > 0, PROCESS_NAMES.index('Rayl\x00'),
+                                         PROCESS_NAMES.index('compt\x00'))).astype(np.uint8),
+        'comptVolName': np.where(is_electron, VOLUME_NAMES.index('NULL\x00'),
+                                 VOLUME_NAMES.index('crystal\x00')).astype(np.uint8),
+        'RayleighVolName': rayleigh_volume.astype(np.uint8),
+    }
+    categories = {'processName': dl.StringCategories(PROCESS_NAMES),
+                  'comptVolName': dl.StringCategories(VOLUME_NAMES),
+                  'RayleighVolName': dl.StringCategories(VOLUME_NAMES)}
+    return dl.HitTable(columns, categories)
+
+
+def write_root(hits, file_name):
+    """
+    Writes hits to the Hits tree of a ROOT file (requires ROOT with RDataFrame.FromNumpy).
+    :param hits: HitTable object.
+    :param file_name: Name of the output file.
+    :return: nothing
+    """
+    import ROOT
+    columns = {}
+    for name in dl.HIT_BRANCHES:
+        values = hits.columns[name]
+        if name == 'volumeID':
+            for ii in range(dl.VOLUME_ID_SIZE):
+                columns['volumeID_{}'.format(ii)] = np.ascontiguousarray(values[:, ii])
+        elif name in dl.STRING_BRANCHES:
+            columns[name+'_code'] = values.astype(np.int32)
+        else:
+            columns[name] = np.ascontiguousarray(values)
+    frame = ROOT.RDF.FromNumpy(columns)
+    for name in dl.STRING_BRANCHES:
+        # octal escapes keep the trailing null characters of the names
+        literals = ['std::string("{}", {})'.format(''.join('\\{:03o}'.format(ord(ch)) for ch in value), len(value))
+                    for value in hits.categories[name].names]
+        frame = frame.Define(name, 'static const std::vector<std::string> names{{{}}}; return names[{}_code];'
+                             .format(', '.join(literals), name))
+    frame = frame.Define('volumeID', 'ROOT::RVec<int>{{{}}}'.format(', '.join('volumeID_{}'.format(ii)
+                                                                           for ii in range(dl.VOLUME_ID_SIZE))))
+    frame.Snapshot('Hits', file_name, dl.HIT_BRANCHES)
+
+
+def write_hits(hits, file_name):
+    """
+    Writes hits to a .npz file (HitTable.save) or, for names ending with .root, to a ROOT file.
+    :param hits: HitTable object.
+    :param file_name: Name of the output file.
+    :return: nothing
+    """
+    if file_name.endswith('.root'):
+        write_root(hits, file_name)
+    else:
+        hits.save(file_name)
+
+
+def generate_dataset(directory, n_files=1, n_events=100000, file_format='npz', seed=0, **parameters):
+    """
+    Generates files with 511 keV and prompt data named like the simulation output: anni{i} and prompt{i}.
+    :param directory: Output directory.
+    :param n_files: Number of files of each kind.
+    :param n_events: Number of decays in every file.
+    :param file_format: 'npz' or 'root'.
+    :param seed: Seed of the random number generator, every file uses a different seed derived from it.
+    :param parameters: Other parameters of generate_hits.
+    :return: Lists of names of 511 keV files and prompt files.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    files_511 = []
+    files_prompt = []
+    for ii in range(1, n_files+1):
+        for kind, prefix, file_list in (('511', 'anni', files_511), ('prompt', 'prompt', files_prompt)):
+            file_name = os.path.join(directory, '{}{}.{}'.format(prefix, ii, file_format))
+            start = time.time()
+            hits = generate_hits(n_events, kind, seed=(seed, ii, len(prefix)), first_event_id=(ii-1)*n_events,
+                                 **parameters)
+            elapsed = time.time()-start
+            write_hits(hits, file_name)
+            print('[GENERATED: {} ({} HITS, {:.0f} HITS/S)]'.format(file_name, len(hits),
+                                                                    len(hits)/elapsed if elapsed > 0 else 0.0))
+            file_list.append(file_name)
+    return files_511, files_prompt
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generator of synthetic GATE-like Hits data.')
+    parser.add_argument('directory')
+    parser.add_argument('--files', type=int, default=1, help='number of files of each kind')
+    parser.add_argument('--events', type=int, default=100000, help='number of decays in every file')
+    parser.add_argument('--format', choices=('npz', 'root'), default='npz')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate_dataset(args.directory, args.files, args.events, args.format, args.seed)